@@ -19,17 +19,35 @@ if sys.version_info.major < 3:
 
 # Dependencies
 import argparse
+import bisect
+import ctypes
+import ctypes.util
+import getpass
+import hashlib
 import html
 import io
 import json
 import math
+import multiprocessing
 import os
+import queue
+import random
+import select
+import shutil
+import signal
 import socketserver
+import struct
 import tempfile
+import threading
+import time
 import urllib
+import zipfile
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
 from enum import Enum
 from functools import partial
-from glob import glob
 from http import HTTPStatus
 from http.server import SimpleHTTPRequestHandler
 from urllib.parse import parse_qs
@@ -51,6 +69,14 @@ try:
 except ImportError:
     print(IMREAD_NOT_ENABLED_MSG)
 
+PIL_ENABLED = False
+try:
+    from PIL import Image
+    Image.init()
+    PIL_ENABLED = True
+except ImportError:
+    pass
+
 ICON = b"\x00\x00\x01\x00\x01\x00\x10\x10\x00\x00\x01\x00 \x00h\x04\x00\x00\x16\x00\x00\x00(\x00\x00\x00\x10\x00\x00" \
        b"\x00 \x00\x00\x00\x01\x00 \x00\x00\x00\x00\x00\x00\x04\x00\x00\x13\x0b\x00\x00\x13\x0b\x00\x00\x00\x00\x00" \
        b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00" \
@@ -122,6 +148,76 @@ MEDIA_EXTENSIONS = {
 
 PREPROCESSED_MEDIA_TYPES = ['tiff', 'tif']
 
+TIFF_TAG_TYPES = {1: 'B', 2: 'c', 3: 'H', 4: 'I', 5: 'II', 6: 'b', 7: 'B', 8: 'h',
+                  9: 'i', 10: 'ii', 11: 'f', 12: 'd', 16: 'Q', 17: 'q', 18: 'Q'}
+# only unsigned samples are memory-mapped, signed and float ones are decoded by imread
+TIFF_SAMPLE_DTYPES = {(1, 8): 'u1', (1, 16): 'u2', (1, 32): 'u4', (1, 64): 'u8'}
+
+THUMBNAIL_SIZES = [150, 300, 600, 1200]
+# per-user default, so cached thumbnails of one user are never served to or replaced by another
+THUMBNAIL_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'servgallery_cache_{user}'.format(
+    user=os.getuid() if hasattr(os, 'getuid') else getpass.getuser()))
+THUMBNAIL_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+# cache is trimmed to this fraction of its limit, after this fraction of limit is written
+CACHE_TRIM_TARGET = 0.9
+CACHE_TRIM_INTERVAL = 1 / 16
+MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+FRAME_CACHE_SIZE = 256 * 1024 * 1024
+FRAME_READAHEAD = 8
+FRAME_READAHEAD_QUEUE_SIZE = 16
+TIFF_IFDS_CACHE_SIZE = 64
+PREFETCH_WINDOW = 2
+LISTING_PAGE_SIZE = 200
+PRELOAD_THUMBNAILS = 0
+CACHED_API_METHODS = ['count_frames', 'tile_info', 'sprite_map']
+
+SPRITE_MAX_FRAMES = 256
+SPRITE_MAX_PIXELS = 4096 * 4096
+FINGERPRINT_SAMPLES = 8
+FINGERPRINT_BLOCK_SIZE = 4096
+
+METADATA_CACHE_SIZE = 100000
+
+ZIP_CHUNK_SIZE = 64 * 1024
+ZIP_MAX_REQUEST_SIZE = 1024 * 1024
+ZIP_STORED_EXTENSIONS = ['jpg', 'jpeg', 'jfif', 'png', 'apng', 'gif', 'webp', 'mp4', 'avi', 'webm', 'ogg',
+                         'mov', 'mp3', 'mpeg', 'aac', 'zip', 'gz', 'bz2', 'xz', '7z', 'rar']
+
+WORKER_SHUTDOWN_TIMEOUT = 10
+
+WATCHER_POLL_INTERVAL = 2
+WATCHER_QUEUE_SIZE = 1000
+WATCHER_HISTORY_SIZE = 1000
+WATCHER_IDLE_TIMEOUT = 60
+EVENTS_KEEPALIVE_INTERVAL = 15
+PLACEHOLDER_SAMPLES = 16
+PLACEHOLDER_QUEUE_SIZE = 1000
+FINGERPRINT_QUEUE_SIZE = 1000
+
+TILE_SIZE = 256
+EXPORT_DIR_NAME = '.servgallery'
+RATE_LIMIT = 0
+CLIENT_RATE_LIMIT = 0
+CLIENT_BUCKETS_SIZE = 1000
+CLIENT_BUCKETS_PROBES = 16
+BANDWIDTH_CHUNK_SIZE = 64 * 1024
+BANDWIDTH_FREE_BYTES = 256 * 1024
+ACCESS_LOG = '-'
+ACCESS_LOG_LEVELS = ['info', 'warning', 'error']
+ACCESS_LOG_LEVEL = 'info'
+ACCESS_LOG_SAMPLE = 1.0
+ACCESS_LOG_MAX_SIZE = 10 * 1024 * 1024
+ACCESS_LOG_BACKUPS = 5
+ACCESS_LOG_QUEUE_SIZE = 10000
+ACCESS_LOG_BATCH_SIZE = 256
+ACCESS_LOG_FLUSH_TIMEOUT = 2
+IMAGE_FORMAT_TYPES = {'jpg': 'image/jpeg', 'webp': 'image/webp', 'avif': 'image/avif'}
+PIL_IMAGE_FORMATS = {'jpg': 'JPEG', 'webp': 'WEBP', 'avif': 'AVIF'}
+THUMBNAIL_FORMATS = ['webp', 'jpg']
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_PROGRESSIVE = True
+PYRAMID_CACHE_SIZE = 2
+
 GALLERY_CSS = '''
     body {
         margin: 0px;
@@ -232,8 +328,24 @@ GALLERY_CSS = '''
     #media_list {
        text-align:center;
        padding: 0px;
-       display: flex;
-       flex-wrap: wrap;
+       margin: 0px;
+       display: grid;
+    }
+    #preview_list {
+       position: fixed;
+       left: 0px;
+       top: 0px;
+       margin: 0px;
+       padding: 0px 1vw;
+    }
+    body.previewing #main_container {
+       visibility: hidden;
+    }
+    body.previewing #preview_list,
+    body.previewing #current_counter,
+    body.previewing #help_icon,
+    body.previewing #help_display {
+       visibility: visible;
     }
     li.thumbnail {
        list-style-type: none;
@@ -247,7 +359,8 @@ GALLERY_CSS = '''
        display: flex;
        height: 30vh;
        align-items: center;
-       justify-content: center;
+       justify-content: safe center;
+       overflow-x: auto;
        margin: 2px;
     }
     .thumbnail:hover > a {
@@ -257,6 +370,9 @@ GALLERY_CSS = '''
     }
     .thumbnail > .thumbnail_description {
        font-size: 3vh;
+       white-space: nowrap;
+       overflow: hidden;
+       text-overflow: ellipsis;
     }
     .preview_thumbnail > .thumbnail_description {
        font-size: 3vh;
@@ -268,10 +384,31 @@ GALLERY_CSS = '''
     .preview_thumbnail > a {
         height: 95vh;
     }
+    .preview_thumbnail {
+       position: relative;
+    }
+    .tile_viewer {
+       position: absolute;
+       left: 0;
+       top: 0;
+       width: 100%;
+       height: 95vh;
+       overflow: hidden;
+       background-color: #000000cc;
+       border-radius: 0.5em;
+       cursor: grab;
+       touch-action: none;
+    }
+    .tile_viewer > img {
+       position: absolute;
+       user-select: none;
+       pointer-events: none;
+    }
     .thumbnail_ui_el {
        border-radius: 0.5em;
        max-height: 100%;
        max-width: 100%;
+       object-fit: contain;
     }
     #current_counter {
        position: fixed;
@@ -287,8 +424,9 @@ GALLERY_CSS = '''
     }
     '''
 
-GALLERY_JS_GLOBAL_VARS = 'var MEDIA_EXTENSIONS = {};'\
-    .format(str({ext: MEDIA_EXTENSIONS[ext].name for ext in MEDIA_EXTENSIONS}))
+GALLERY_JS_GLOBAL_VARS = 'var MEDIA_EXTENSIONS = {}; var PREPROCESSED_MEDIA_TYPES = {};'\
+    .format(str({ext: MEDIA_EXTENSIONS[ext].name for ext in MEDIA_EXTENSIONS}),
+            str(PREPROCESSED_MEDIA_TYPES))
 
 GALLERY_JS_SCRIPT = \
     GALLERY_JS_GLOBAL_VARS + \
@@ -298,81 +436,327 @@ GALLERY_JS_SCRIPT = \
        parts = parts.reverse();
        return parts[0];
     };
+    function snapThumbnailSize(min_height) {
+       return THUMBNAIL_SIZES.find(size => size >= min_height) || THUMBNAIL_SIZES[THUMBNAIL_SIZES.length - 1];
+    };
+    function exportedUrl(filename, name) {
+       /* files pregenerated by static export for every media file */
+       return ".servgallery/files/" + encodeURIComponent(filename) + "/" + name;
+    };
+    function thumbnailSourceName(filename) {
+       /* byte-identical files share thumbnails of the first of them, so they are downloaded once */
+       let fingerprint = window.media_meta?.[filename]?.fingerprint;
+       if (!fingerprint) {
+           return filename;
+       }
+       window.fingerprint_names ??= {};
+       let name = window.fingerprint_names[fingerprint];
+       if (window.media_meta[name]?.fingerprint !== fingerprint) {
+           name = window.fingerprint_names[fingerprint] = filename;
+       }
+       return name;
+    };
+    function thumbnailUrl(filename, frame_ind, min_height) {
+       filename = thumbnailSourceName(filename);
+       if (STATIC_EXPORT) {
+           if (!PREPROCESSED_MEDIA_TYPES.includes(getExtension(filename))) {
+               return encodeURIComponent(filename);
+           }
+           return exportedUrl(filename, "thumbnail-" + frame_ind + "-" + snapThumbnailSize(min_height ?? 600) + ".jpg");
+       }
+       let url = encodeURIComponent(filename) + "?act=thumbnail&frame_ind=" + frame_ind;
+       if (typeof min_height != "undefined") {
+           url += "&min_height=" + min_height;
+       }
+       if (window.media_versions?.[filename]) {
+           url += "&v=" + window.media_versions[filename];
+       }
+       return url;
+    };
+    function thumbnailSrcset(filename, frame_ind) {
+       /* thumbnails are displayed 30vh high, so every size bucket is
+          described by pixel density and browser picks the smallest adequate */
+       let display_height = window.innerHeight * 0.3;
+       return THUMBNAIL_SIZES.map(size => {
+           return thumbnailUrl(filename, frame_ind, size) + " " + (size / display_height).toFixed(3) + "x";
+       }).join(", ");
+    };
+    function previewUrl(filename) {
+       /* previewed item is displayed 95vh high */
+       if (PREPROCESSED_MEDIA_TYPES.includes(getExtension(filename))) {
+           return thumbnailUrl(filename, 0, snapThumbnailSize(window.innerHeight * 0.95 * window.devicePixelRatio));
+       }
+       return thumbnailUrl(filename, 0);
+    };
+    function setThumbnailSource(img, filename, frame_ind, preview) {
+       if (preview) {
+           img.src = previewUrl(filename);
+           return;
+       }
+       img.src = thumbnailUrl(filename, frame_ind);
+       if (PREPROCESSED_MEDIA_TYPES.includes(getExtension(filename))) {
+           img.srcset = thumbnailSrcset(filename, frame_ind);
+       }
+    };
     function toggleHelp(){
         console.log("help");
         document.getElementById("help_display").classList.toggle("hidden");
     }
     function updateCurrentCounter() {
-        let thumbnails = document.getElementsByClassName("thumbnail");
-        let loaded_media_count = thumbnails.length;
-        let pending_media_count = 0;
-        if (window.hasOwnProperty("media_queue")) {
-           pending_media_count = window.media_queue.length;
-        }
-        let total_count = loaded_media_count + pending_media_count;
-        let current_counter = Array.from(thumbnails).indexOf(window.selected_thumbnail);
+        let total_count = window.media_list?.length ?? 0;
         let current_counter_el = document.getElementById("current_counter");
-        if (current_counter >= 0) {
-            current_counter_el.innerText = (current_counter + 1) + "/" + total_count;
+        if (typeof window.selected_thumbnail != "undefined") {
+            current_counter_el.innerText = (window.selected_index + 1) + "/" + total_count;
         } else {
             current_counter_el.innerText = total_count;
         }
     };
     function init() {
-       fetch("/api/list_directory?path=" + location.pathname + "&only_files=yes")
+       window.media_meta = {};
+       window.media_list = [];
+       window.non_media_list = [];
+       if (STATIC_EXPORT) {
+           fetch(".servgallery/list.json")
+               .then((r) => { return r.json(); })
+               .then((data) => { initListing(data, true); });
+           return;
+       }
+       /* first page of listing is embedded in the page */
+       initListing(INITIAL_LISTING, INITIAL_LISTING.length < LISTING_PAGE_SIZE);
+    };
+    function initListing(data, complete) {
+       appendListing(data);
+       window.listing_complete = complete;
+       initGrid();
+       previewLinkedItem();
+       updateCurrentCounter();
+       if (STATIC_EXPORT) {
+           return;
+       }
+       if (!complete) {
+           /* events are applied once the whole listing is loaded */
+           window.pending_events = [];
+           fetchListingPage(window.listing_after, window.media_list.length);
+       }
+       if (typeof EventSource != "undefined") {
+           watchDirectory();
+       }
+    };
+    function appendListing(data) {
+       for (let el of data) {
+           window.media_meta[el.name] = el;
+           if (getExtension(el.name) in MEDIA_EXTENSIONS) {
+               window.media_list.push(el.name);
+           } else {
+               window.non_media_list.push(el.name);
+               appendNonMediaFile(el.name);
+           }
+       }
+       if (data.length > 0) {
+           window.listing_after = data[data.length - 1].name;
+       }
+    };
+    function syncListing() {
+       /* listing is fetched again from its start and compared with the shown one,
+          events coming meanwhile are held back and applied after it */
+       window.pending_events ??= [];
+       window.listing_sync = {};
+       fetchListingPage(undefined, 0);
+    };
+    function fetchListingPage(after, count) {
+       /* pages grow with loaded listing, so large directories take few requests,
+          and each starts after the last loaded name, so files added or removed
+          meanwhile never shift names between pages */
+       let sync = window.listing_sync;
+       let limit = Math.max(count, LISTING_PAGE_SIZE);
+       let url = "/api/list_directory?path=" + location.pathname + "&only_files=yes&with_meta=yes&limit=" + limit;
+       if (typeof after != "undefined") {
+           url += "&after=" + encodeURIComponent(after);
+       }
+       fetch(url)
            .then((r) => { return r.json(); })
            .then((data) => {
-               window.non_media_list = data.filter(el => {
-                   return !(getExtension(el) in MEDIA_EXTENSIONS);
-               });
-               window.media_queue = data.filter(el => {
-                   return getExtension(el) in MEDIA_EXTENSIONS;
-               });
+               if (sync !== window.listing_sync) {
+                   /* listing is synced again meanwhile */
+                   return;
+               }
+               let last = data.length < limit ? undefined : data[data.length - 1].name;
+               syncListingPage(after, last, data);
+               renderGrid(true);
+               previewLinkedItem();
                updateCurrentCounter();
-               initNonMedia();
-               loadMedia();
+               if (typeof last != "undefined") {
+                   fetchListingPage(last, count + data.length);
+                   return;
+               }
+               window.listing_complete = true;
+               let pending = window.pending_events ?? [];
+               window.pending_events = undefined;
+               for (let apply of pending) {
+                   apply();
+               }
+           })
+           .catch(() => {
+               setTimeout(() => {
+                   if (sync === window.listing_sync) {
+                       fetchListingPage(after, count);
+                   }
+               }, 3000);
            });
     };
-    function initNonMedia() {
-       if (window.hasOwnProperty("non_media_list")) {
-           for (let name of window.non_media_list) {
-               appendNonMediaFile(name);
+    function syncListingPage(after, last, data) {
+       /* page holds all names after "after" up to "last", or up to the end if it is undefined */
+       if (!window.listing_complete && after === window.listing_after) {
+           /* page continues shown listing */
+           appendListing(data);
+           return;
+       }
+       let names = new Set(data.map(el => el.name));
+       for (let name of Object.keys(window.media_meta)) {
+           if ((typeof after == "undefined" || name > after) && (typeof last == "undefined" || name <= last)
+                   && !names.has(name)) {
+               removeFile(name);
            }
        }
+       for (let el of data) {
+           let meta = window.media_meta[el.name];
+           if (typeof meta == "undefined") {
+               addFile(el);
+           } else if (meta.fingerprint !== el.fingerprint) {
+               modifyFile(el);
+           } else {
+               window.media_meta[el.name] = el;
+           }
+       }
+       if (!window.listing_complete && (typeof last == "undefined" || !(last < window.listing_after))) {
+           window.listing_after = last;
+       }
+    };
+    function previewLinkedItem() {
+       /* open item from link, once its page of listing is loaded */
+       if (window.linked_item_opened || document.location.hash.length <= 1) {
+           return;
+       }
+       if (typeof window.selected_index != "undefined") {
+           /* user has picked another item meanwhile */
+           window.linked_item_opened = true;
+           return;
+       }
+       let index = window.media_list.findIndex(name => {
+           return encodeURIComponent(name) === document.location.hash.slice(1);
+       });
+       if (index >= 0) {
+           window.linked_item_opened = true;
+           preview(index);
+       }
     };
     function appendNonMediaFile(name) {
-       li = document.createElement("li");
+       let li = document.createElement("li");
        li.classList.add("dir");
-       link = document.createElement("a");
+       li.id = encodeURIComponent(name);
+       let link = document.createElement("a");
        link.href = name;
        link.innerText = name;
        li.appendChild(link);
        document.getElementById("non_media_list").appendChild(li);
+       return li;
+    };
+    /* rows rendered above and below the visible ones */
+    const GRID_BUFFER_ROWS = 2;
+    function initGrid() {
+       /* only rows around the viewport are in the DOM and tiles scrolled away are reused,
+          so the page stays light whatever the number of files */
+       window.grid = {tiles: new Map(), pool: [], first: 0, last: 0,
+                      observer: new IntersectionObserver(() => renderGrid())};
+       /* tiles report scrolling within the list, the list itself reports scrolling to it */
+       window.grid.observer.observe(document.getElementById("media_list"));
+       measureGrid();
+       window.addEventListener("resize", () => {
+           measureGrid();
+           renderGrid(true);
+       });
+       renderGrid(true);
+    };
+    function measureGrid() {
+       /* all tiles have the same size, so it is taken from a probe tile */
+       let list = document.getElementById("media_list");
+       let probe = fillThumbnail(document.createElement("li"), "probe");
+       list.appendChild(probe);
+       let style = getComputedStyle(probe);
+       let margin_x = parseFloat(style.marginLeft) + parseFloat(style.marginRight);
+       let margin_y = parseFloat(style.marginTop) + parseFloat(style.marginBottom);
+       let height = probe.getBoundingClientRect().height;
+       probe.remove();
+       window.grid.columns = Math.max(1, Math.floor(list.clientWidth / (window.innerHeight * 0.4 + margin_x)));
+       window.grid.row_height = height + margin_y;
+       list.style.gridTemplateColumns = "repeat(" + window.grid.columns + ", minmax(0, 1fr))";
+       list.style.gridAutoRows = height + "px";
     };
-    function loadMedia() {
-       if (window.hasOwnProperty("media_queue")) {
-           let n = 8;
-           let queue_length = window.media_queue.length;
-           for (let i = 0; i < Math.min(n, queue_length); ++i) {
-               let name = window.media_queue.shift();
-               appendThumbnail(name);
+    function renderGrid(force) {
+       let grid = window.grid;
+       let list = document.getElementById("media_list");
+       let rows = Math.ceil(window.media_list.length / grid.columns);
+       let top = -list.getBoundingClientRect().top;
+       let last_row = Math.min(rows, Math.ceil((top + window.innerHeight) / grid.row_height) + GRID_BUFFER_ROWS);
+       let first_row = Math.max(0, Math.min(last_row, Math.floor(top / grid.row_height) - GRID_BUFFER_ROWS));
+       let first = first_row * grid.columns;
+       let last = Math.min(window.media_list.length, last_row * grid.columns);
+       if (!force && first === grid.first && last === grid.last) {
+           return;
+       }
+       grid.first = first;
+       grid.last = last;
+       for (let index of grid.tiles.keys()) {
+           if (index < first || index >= last) {
+               recycleTile(index);
            }
        }
-       /* load until selected item */
-       let selected_file = document.location.hash.slice(1);
-       if (selected_file.length > 0) {
-           let selected_file_el = document.getElementById(selected_file)
-           if (selected_file_el == null) {
-               setTimeout(loadMedia, 1000);
+       let cursor = list.firstChild;
+       for (let index = first; index < last; ++index) {
+           let li = grid.tiles.get(index);
+           if (li == null) {
+               li = fillThumbnail(grid.pool.pop() || document.createElement("li"), window.media_list[index]);
+               li.dataset.index = index;
+               grid.tiles.set(index, li);
+               grid.observer.observe(li);
+           }
+           if (li === cursor) {
+               cursor = cursor.nextSibling;
            } else {
-               preview(selected_file_el);
+               list.insertBefore(li, cursor);
            }
        }
-       /* while not enought elements loaded onscroll will not be called */
-       if(document.scrollingElement.scrollHeight <= document.scrollingElement.clientHeight) {
-           setTimeout(loadMedia, 1000);
+       /* padding stands for rows which are not rendered */
+       list.style.paddingTop = (first_row * grid.row_height) + "px";
+       list.style.paddingBottom = ((rows - last_row) * grid.row_height) + "px";
+    };
+    function recycleTile(index) {
+       let li = window.grid.tiles.get(index);
+       window.grid.tiles.delete(index);
+       window.grid.observer.unobserve(li);
+       li.remove();
+       li.replaceChildren();
+       window.grid.pool.push(li);
+    };
+    function shiftTiles(from, delta) {
+       /* keep rendered tiles attached to their files when files are added or removed */
+       let shifted = Array.from(window.grid.tiles).filter(([index, li]) => index >= from);
+       for (let [index, li] of shifted) {
+           window.grid.tiles.delete(index);
+       }
+       for (let [index, li] of shifted) {
+           li.dataset.index = index + delta;
+           window.grid.tiles.set(index + delta, li);
+       }
+       if (window.selected_index >= from) {
+           window.selected_index += delta;
        }
     };
+    function scrollToTile(index) {
+       let list = document.getElementById("media_list");
+       let row = Math.floor(index / window.grid.columns);
+       window.scrollTo(0, list.getBoundingClientRect().top + window.scrollY + row * window.grid.row_height);
+    };
     function onImageError(event) {
        event.srcElement.src= 
            "data:image/svg+xml;charset=utf-8,"
@@ -391,7 +775,84 @@ GALLERY_JS_SCRIPT = \
            + "</text></g></svg>";
        event.srcElement.onerror = null;
     };
-    function appendThumbnail(filename) {
+    function apiImagePath(filename) {
+       return encodeURIComponent(decodeURIComponent(location.pathname) + filename);
+    };
+    /* sprites kept loaded, so tiles scrolled back into view draw their frames at once */
+    const SPRITE_CACHE_SIZE = 64;
+    function loadSprite(filename, min_height, start) {
+       /* promise of sprite map with its loaded sprite image, shared by all tiles of file */
+       window.sprite_cache ??= new Map();
+       let version = window.media_versions?.[filename] ?? "";
+       let key = [filename, version, min_height, start].join("\0");
+       let sprite = window.sprite_cache.get(key);
+       if (sprite != null) {
+           /* least recently used sprites are evicted first */
+           window.sprite_cache.delete(key);
+           window.sprite_cache.set(key, sprite);
+           return sprite;
+       }
+       let url = "/api/sprite_map?image_path=" + apiImagePath(filename)
+                 + "&min_height=" + min_height + "&start=" + start;
+       if (STATIC_EXPORT) {
+           url = exportedUrl(filename, "sprite-" + min_height + "-" + start + ".json");
+       }
+       sprite = fetch(url)
+           .then(r => { return r.ok ? r.json() : null; })
+           .then(sprite_map => {
+              if (sprite_map == null) {
+                  return null;
+              }
+              return new Promise((resolve, reject) => {
+                  let image = new Image();
+                  image.onload = () => resolve({map: sprite_map, image: image});
+                  image.onerror = reject;
+                  if (STATIC_EXPORT) {
+                      image.src = exportedUrl(filename, "sprite-" + sprite_map.min_height + "-"
+                                                        + sprite_map.start + ".jpg");
+                  } else {
+                      image.src = encodeURIComponent(filename) + "?act=sprite&min_height=" + sprite_map.min_height
+                                  + "&start=" + sprite_map.start + "&stop=" + sprite_map.stop
+                                  + (version ? "&v=" + version : "");
+                  }
+              });
+           });
+       /* failed loads are tried again by next tile */
+       sprite.catch(() => {
+           if (window.sprite_cache.get(key) === sprite) {
+               window.sprite_cache.delete(key);
+           }
+       });
+       window.sprite_cache.set(key, sprite);
+       if (window.sprite_cache.size > SPRITE_CACHE_SIZE) {
+           window.sprite_cache.delete(window.sprite_cache.keys().next().value);
+       }
+       return sprite;
+    };
+    function appendFrames(link, filename, start) {
+       /* remaining frames come packed in one sprite image per range of frames */
+       let min_height = snapThumbnailSize(window.innerHeight * 0.3 * window.devicePixelRatio);
+       loadSprite(filename, min_height, start).then(sprite => {
+           /* link is detached once its tile is recycled or refilled for another file */
+           if (sprite == null || !link.isConnected) {
+               return;
+           }
+           for (let frame of sprite.map.frames) {
+               let canvas = document.createElement("canvas");
+               canvas.classList.add("thumbnail_ui_el");
+               canvas.width = frame.width;
+               canvas.height = frame.height;
+               canvas.title = filename + " [" + frame.frame_ind + "]";
+               canvas.getContext("2d").drawImage(sprite.image, frame.x, frame.y, frame.width, frame.height,
+                                                 0, 0, frame.width, frame.height);
+               link.appendChild(canvas);
+           }
+           if (sprite.map.stop < sprite.map.frames_count) {
+               appendFrames(link, filename, sprite.map.stop);
+           }
+       }, () => {});
+    };
+    function fillThumbnail(li, filename, preview) {
        let extension = getExtension(filename);
        let media_type = MEDIA_EXTENSIONS[extension];
        let link = document.createElement("a");
@@ -401,23 +862,25 @@ GALLERY_JS_SCRIPT = \
            case "IMAGE": {
                let img = document.createElement("img");
                img.classList.add("thumbnail_ui_el");
-               img.src = encodeURIComponent(filename) + "?act=thumbnail&frame_ind=0";
+               setThumbnailSource(img, filename, 0, preview);
                img.alt = "Browser can't display raw image. " 
                          + "Please install imread (https://github.com/luispedro/imread).";
                img.onerror = onImageError;
+               img.loading = preview ? "eager" : "lazy";
+               img.decoding = "async";
+               let meta = window.media_meta?.[filename];
+               if (meta?.width && meta?.height) {
+                   /* reserve space before thumbnail arrives */
+                   img.style.aspectRatio = meta.width + " / " + meta.height;
+                   img.style.height = "min(100%, " + meta.height + "px)";
+               }
+               if (meta?.placeholder) {
+                   img.style.backgroundColor = meta.placeholder;
+               }
                link.appendChild(img);
-               fetch("/api/count_frames?image_path=" + encodeURIComponent(filename))
-                   .then(r => {return r.json(); })
-                   .then(data => {
-                      let frames_num = data;
-                      for (let i = 1; i < frames_num; ++i) {
-                          img = document.createElement("img");
-                          img.classList.add("thumbnail_ui_el");
-                          img.src = encodeURIComponent(filename) + "?act=thumbnail&frame_ind=" + i;
-                          img.alt = filename;
-                          link.appendChild(img);
-                      }
-                   });
+               if (PREPROCESSED_MEDIA_TYPES.includes(extension)) {
+                   appendFrames(link, filename, 1);
+               }
                break;
            }
            case "VIDEO": {
@@ -449,39 +912,100 @@ GALLERY_JS_SCRIPT = \
                break;
            }
        }
-       let li = document.createElement("li");
-       li.classList.add("thumbnail");
-       li.id = encodeURIComponent(filename);
-       li.appendChild(link);
+       li.replaceChildren(link);
+       li.className = "thumbnail";
        let description_div = document.createElement("div");
        description_div.classList.add("thumbnail_description");
        description_div.innerText = filename;
        li.appendChild(description_div);
-       document.getElementById("media_list").appendChild(li);
+       return li;
     };
-    function loadMediaUncomment() {
-        let n = 8;
-        let l = document.getElementsByClassName("thumbnail");
-        let t = document.createElement("template");
-        Array.from(l)
-            .filter(el => el.firstChild.nodeType === 8)
-            .slice(0, n)
-            .forEach(el => { t.innerHTML = el.firstChild.data;
-                             el.firstChild.replaceWith(t.content);
-                            }
-                     );
-        /* while not enought elements loaded onscroll will not be called */
-        if(document.scrollingElement.scrollHeight <= document.scrollingElement.clientHeight) {
-            setTimeout(loadMedia, 10000);
-        }
+    function addFile(meta) {
+       let name = meta.name;
+       if (document.getElementById(encodeURIComponent(name)) != null
+               || window.media_list.includes(name)) {
+           /* listing read after the event already has the file */
+           if (window.media_meta[name]?.fingerprint !== meta.fingerprint) {
+               modifyFile(meta);
+           }
+           window.media_meta[name] = meta;
+           return;
+       }
+       window.media_meta[name] = meta;
+       if (!(getExtension(name) in MEDIA_EXTENSIONS)) {
+           let next = null;
+           for (let li of document.getElementById("non_media_list").children) {
+               if (decodeURIComponent(li.id) > name) {
+                   next = li;
+                   break;
+               }
+           }
+           document.getElementById("non_media_list").insertBefore(appendNonMediaFile(name), next);
+           return;
+       }
+       let i = window.media_list.findIndex(el => el > name);
+       i = i < 0 ? window.media_list.length : i;
+       window.media_list.splice(i, 0, name);
+       shiftTiles(i, 1);
+       renderGrid(true);
+       updateCurrentCounter();
     };
-    function checkEndOfScroll() {
-        if ((window.innerHeight * 1.5 + window.scrollY) >= document.body.offsetHeight) {
-            loadMedia();
-        }
+    function removeFile(name) {
+       delete window.media_meta[name];
+       let i = window.media_list.indexOf(name);
+       if (i < 0) {
+           document.getElementById(encodeURIComponent(name))?.remove();
+           return;
+       }
+       if (i === window.selected_index) {
+           closePreview();
+           window.selected_index = undefined;
+       }
+       window.media_list.splice(i, 1);
+       if (window.grid.tiles.has(i)) {
+           recycleTile(i);
+       }
+       shiftTiles(i + 1, -1);
+       renderGrid(true);
+       updateCurrentCounter();
+    };
+    function modifyFile(meta) {
+       let name = meta.name;
+       window.media_meta[name] = meta;
+       window.media_versions[name] = Date.now();
+       let i = window.media_list.indexOf(name);
+       let li = window.grid.tiles.get(i);
+       if (li != null) {
+           fillThumbnail(li, name);
+       }
+       if (i === window.selected_index && typeof window.selected_thumbnail != "undefined") {
+           preview(i, true);
+       }
     };
-    window.onscroll = function(ev) {
-       checkEndOfScroll();
+    function watchDirectory() {
+       /* stream starts after the position embedded listing was read at and resumes after
+          the last received event on reconnect, so listing is synced again only on "reset",
+          when server lost events */
+       window.media_versions = {};
+       let url = location.pathname + "?act=events";
+       if (WATCH_POSITION != null) {
+           url += "&since=" + encodeURIComponent(WATCH_POSITION);
+       }
+       let events = new EventSource(url);
+       let listen = (type, apply) => {
+           events.addEventListener(type, event => {
+               let data = JSON.parse(event.data);
+               if (typeof window.pending_events != "undefined") {
+                   window.pending_events.push(() => apply(data));
+               } else {
+                   apply(data);
+               }
+           });
+       };
+       listen("add", addFile);
+       listen("remove", data => removeFile(data.name));
+       listen("modify", modifyFile);
+       events.addEventListener("reset", () => syncListing());
     };
     window.onload = function() {
         updateCurrentCounter();
@@ -507,6 +1031,9 @@ GALLERY_JS_SCRIPT = \
             case 83:
                 saveCurrent();
                 break;
+            case 90:
+                saveDirectory();
+                break;
             case 72:
             case 27:
                 toggleHelp();
@@ -523,22 +1050,11 @@ GALLERY_JS_SCRIPT = \
         }
     };
     function previewNext() {
-        if (typeof window.selected_thumbnail == "undefined") {
-            let thumbnails = document.getElementsByClassName("thumbnail");
-            if (thumbnails.length > 0) {
-                let first = thumbnails[0];
-                window.selected_thumbnail = first;
-                preview(first);
-            }
-        } else {
-            let current = window.selected_thumbnail;
-            preview(current.nextSibling);
-        }
+        preview(typeof window.selected_index == "undefined" ? 0 : window.selected_index + 1);
     };
     function previewPrevious() {
-        if (typeof window.selected_thumbnail != "undefined") {
-            let current = window.selected_thumbnail;
-            preview(current.previousSibling);
+        if (typeof window.selected_index != "undefined") {
+            preview(window.selected_index - 1);
         }
     };
     screen.orientation.addEventListener("change", (event) => {
@@ -604,32 +1120,199 @@ GALLERY_JS_SCRIPT = \
             content.onload = _update_background;
         }
     }
-    function preview(thumbnail) {
-        if (!thumbnail || thumbnail?.classList.contains("preview_thumbnail")) {
+    function openTileViewer(thumbnail) {
+        let filename = decodeURIComponent(thumbnail.id);
+        if (STATIC_EXPORT || !PREPROCESSED_MEDIA_TYPES.includes(getExtension(filename))) {
+            return;
+        }
+        fetch("/api/tile_info?image_path=" + apiImagePath(filename) + "&frame_ind=0")
+            .then(r => { return r.ok ? r.json() : null; })
+            .then(info => {
+                if (info == null || window.selected_thumbnail !== thumbnail
+                        || thumbnail.querySelector(".tile_viewer") != null) {
+                    return;
+                }
+                let el = document.createElement("div");
+                el.classList.add("tile_viewer");
+                thumbnail.appendChild(el);
+                let viewer = {el: el, info: info, tiles: new Map(),
+                              url: encodeURIComponent(filename) + "?act=tile&frame_ind=0",
+                              zoom: Math.min(el.clientWidth / info.width, el.clientHeight / info.height),
+                              cx: info.width / 2, cy: info.height / 2, drag: null, dragged: false};
+                el.onwheel = (event) => {
+                    event.preventDefault();
+                    let rect = el.getBoundingClientRect();
+                    let px = event.clientX - rect.left - el.clientWidth / 2;
+                    let py = event.clientY - rect.top - el.clientHeight / 2;
+                    let factor = event.deltaY < 0 ? 1.25 : 0.8;
+                    viewer.cx += px / viewer.zoom - px / (viewer.zoom * factor);
+                    viewer.cy += py / viewer.zoom - py / (viewer.zoom * factor);
+                    viewer.zoom *= factor;
+                    renderTiles(viewer);
+                };
+                el.onpointerdown = (event) => {
+                    viewer.drag = {x: event.clientX, y: event.clientY};
+                    viewer.dragged = false;
+                    el.setPointerCapture(event.pointerId);
+                };
+                el.onpointermove = (event) => {
+                    if (viewer.drag == null) {
+                        return;
+                    }
+                    viewer.cx -= (event.clientX - viewer.drag.x) / viewer.zoom;
+                    viewer.cy -= (event.clientY - viewer.drag.y) / viewer.zoom;
+                    viewer.drag = {x: event.clientX, y: event.clientY};
+                    viewer.dragged = true;
+                    renderTiles(viewer);
+                };
+                el.onpointerup = () => { viewer.drag = null; };
+                el.onclick = (event) => {
+                    if (viewer.dragged) {
+                        event.stopPropagation();
+                    }
+                };
+                renderTiles(viewer);
+            });
+    };
+    function renderTiles(viewer) {
+        let info = viewer.info;
+        let width = viewer.el.clientWidth;
+        let height = viewer.el.clientHeight;
+        /* pick the coarsest level which still has at least one pixel per screen pixel */
+        let level = info.max_level - Math.floor(Math.log2(Math.max(1, 1 / viewer.zoom)));
+        level = Math.min(info.max_level, Math.max(0, level));
+        let scale = Math.pow(2, info.max_level - level);
+        let span = info.tile_size * scale;
+        let left = viewer.cx - width / 2 / viewer.zoom;
+        let top = viewer.cy - height / 2 / viewer.zoom;
+        let x_first = Math.max(0, Math.floor(left / span));
+        let x_last = Math.min(Math.ceil(info.width / span), Math.ceil((left + width / viewer.zoom) / span));
+        let y_first = Math.max(0, Math.floor(top / span));
+        let y_last = Math.min(Math.ceil(info.height / span), Math.ceil((top + height / viewer.zoom) / span));
+        let visible = new Set();
+        for (let y = y_first; y < y_last; ++y) {
+            for (let x = x_first; x < x_last; ++x) {
+                let key = level + "/" + x + "/" + y;
+                visible.add(key);
+                let img = viewer.tiles.get(key);
+                if (img == null) {
+                    img = document.createElement("img");
+                    img.src = viewer.url + "&level=" + level + "&x=" + x + "&y=" + y;
+                    img.draggable = false;
+                    viewer.tiles.set(key, img);
+                    viewer.el.appendChild(img);
+                }
+                let x0 = x * span;
+                let y0 = y * span;
+                img.style.left = ((x0 - left) * viewer.zoom) + "px";
+                img.style.top = ((y0 - top) * viewer.zoom) + "px";
+                img.style.width = (Math.min(span, info.width - x0) * viewer.zoom) + "px";
+                img.style.height = (Math.min(span, info.height - y0) * viewer.zoom) + "px";
+            }
+        }
+        for (let [key, img] of viewer.tiles) {
+            if (!visible.has(key)) {
+                img.remove();
+                viewer.tiles.delete(key);
+            }
+        }
+    };
+    function closeTileViewer(thumbnail) {
+        let viewer_el = thumbnail.querySelector(".tile_viewer");
+        if (viewer_el != null) {
+            viewer_el.remove();
+        }
+    };
+    function prefetchNeighbours(index) {
+        /* load images next to previewed item in advance, cancel prefetches out of the window;
+           images are loaded as images, so they are requested with the same Accept header as the preview */
+        let wanted = new Set();
+        for (let i = 1; i <= PREFETCH_WINDOW; ++i) {
+            for (let neighbour of [index + i, index - i]) {
+                let name = window.media_list[neighbour];
+                if (name != null && MEDIA_EXTENSIONS[getExtension(name)] === "IMAGE") {
+                    wanted.add(previewUrl(name));
+                }
+            }
+        }
+        if (!window.hasOwnProperty("prefetches")) {
+            window.prefetches = new Map();
+        }
+        for (let [url, img] of window.prefetches) {
+            if (!wanted.has(url)) {
+                // dropping source cancels pending load
+                img.src = "";
+                window.prefetches.delete(url);
+            }
+        }
+        for (let url of wanted) {
+            if (window.prefetches.has(url)) {
+                continue;
+            }
+            let img = new Image();
+            img.fetchPriority = "low";
+            let done = () => {
+                if (window.prefetches.get(url) === img) {
+                    window.prefetches.delete(url);
+                }
+            };
+            img.onload = done;
+            img.onerror = done;
+            window.prefetches.set(url, img);
+            img.src = url;
+        }
+    };
+    function preview(index, force) {
+        /* previewed item is shown over the grid, so grid layout never changes */
+        if (!(index >= 0 && index < window.media_list.length)
+                || (index === window.selected_index && typeof window.selected_thumbnail != "undefined" && !force)) {
             return;
         }
         if (typeof window.selected_thumbnail != "undefined") {
-            window.selected_thumbnail.classList.remove("preview_thumbnail");
+            closeTileViewer(window.selected_thumbnail);
         }
-        document.location.hash = thumbnail.id;
+        let name = window.media_list[index];
+        document.location.hash = encodeURIComponent(name);
         document.activeElement.blur();
+        let thumbnail = fillThumbnail(document.createElement("li"), name, true);
+        thumbnail.id = encodeURIComponent(name);
         thumbnail.classList.add("preview_thumbnail");
-        thumbnail.scrollIntoView();
+        document.getElementById("preview_list").replaceChildren(thumbnail);
+        document.body.classList.add("previewing");
         thumbnail.querySelector("a.thumbnail_src").focus();
         window.selected_thumbnail = thumbnail;
+        window.selected_index = index;
         update_background();
         updateCurrentCounter();
         let thumbnail_ui_list = thumbnail.getElementsByClassName("thumbnail_ui_el");
         if (thumbnail_ui_list.length > 0) {
             thumbnail_ui_list[0].focus();
         }
-       checkEndOfScroll();
+        openTileViewer(thumbnail);
+        prefetchNeighbours(index);
+    };
+    function closePreview() {
+        if (typeof window.selected_thumbnail == "undefined") {
+            return;
+        }
+        closeTileViewer(window.selected_thumbnail);
+        window.selected_thumbnail = undefined;
+        document.getElementById("preview_list").replaceChildren();
+        document.body.classList.remove("previewing");
+        scrollToTile(window.selected_index);
+        updateCurrentCounter();
     };
     function saveCurrent() {
         if (typeof window.selected_thumbnail != "undefined") {
             save(window.selected_thumbnail);
         }
     };
+    function saveDirectory() {
+        if (STATIC_EXPORT) {
+            return;
+        }
+        location.href = location.pathname + "?act=zip";
+    };
     function get_url(thumbnail) {
         return thumbnail.querySelector("a.thumbnail_src").href;
     };
@@ -652,10 +1335,9 @@ GALLERY_JS_SCRIPT = \
             let thumbnail = event.target.closest(".thumbnail");
             if (thumbnail) {
                 if (thumbnail.classList.contains("preview_thumbnail")) {
-                    thumbnail.classList.remove("preview_thumbnail");
-                    thumbnail.scrollIntoView();
+                    closePreview();
                 } else {
-                    preview(thumbnail);
+                    preview(Number(thumbnail.dataset.index));
                 }
             }
         }
@@ -701,6 +1383,10 @@ HELP_DISPLAY = '''\
        <span class="shortcut_descr">Download current item</span>
        <span class="shortcut_key">s</span>
    </div>
+   <div class="shortcut">
+       <span class="shortcut_descr">Download directory as ZIP</span>
+       <span class="shortcut_key">z</span>
+   </div>
    <div class="shortcut">
        <span class="shortcut_descr">Preview item under cursor</span>
        <span class="shortcut_key">Enter</span>
@@ -742,6 +1428,7 @@ GALLERY_HTML = '''\
             <div id="non_media_list"></div>
             <div onclick="handleMediaListClick(event)">
                 <ul id="media_list"></ul>
+                <ul id="preview_list"></ul>
             </div>
             <p id="current_counter"></p>
         </div>
@@ -763,127 +1450,1435 @@ def _is_media_file(path, media_type=None):
     return False
 
 
-def _get_thumbnail(image_path, min_height, frame_ind):
-    frames = imread.imread_multi(image_path)
-    if 0 <= frame_ind < len(frames):
-        img = frames[frame_ind]
-        shape = img.shape
-        subsample = math.floor(shape[0] / min_height)
-        if len(shape) == 2:
-            return img[::subsample, ::subsample]
-        elif len(shape) == 3:
-            return img[::subsample, ::subsample, :]
-    return None
+def _read_tiff_ifds(f, byteorder, bigtiff):
+    """
+    Read tags of every image file directory (page) of TIFF file.
+    @param f: file object opened in binary mode
+    @param byteorder: '<' or '>'
+    @param bigtiff: True for BigTIFF (version 43) layout
+    @return: list of {tag: tuple of values}
+    @raise ValueError: if directories or values don't fit in file
+    """
+    file_size = os.fstat(f.fileno()).st_size
+    if bigtiff:
+        offset_fmt, count_fmt, value_count_fmt, entry_size = 'Q', 'Q', 'Q', 20
+        f.seek(8)
+    else:
+        offset_fmt, count_fmt, value_count_fmt, entry_size = 'I', 'H', 'I', 12
+        f.seek(4)
+    offset_size = struct.calcsize(offset_fmt)
+    count_size = struct.calcsize(count_fmt)
+    ifd_offset, = struct.unpack(byteorder + offset_fmt, f.read(offset_size))
+    ifds = list()
+    visited = set()
+    while ifd_offset and ifd_offset not in visited:
+        visited.add(ifd_offset)
+        if ifd_offset + count_size > file_size:
+            raise ValueError('TIFF directory out of file')
+        f.seek(ifd_offset)
+        n_entries, = struct.unpack(byteorder + count_fmt, f.read(count_size))
+        if ifd_offset + count_size + n_entries * entry_size + offset_size > file_size:
+            raise ValueError('Truncated TIFF file')
+        entries = f.read(n_entries * entry_size)
+        next_offset = f.read(offset_size)
+        if len(entries) < n_entries * entry_size or len(next_offset) < offset_size:
+            raise ValueError('Truncated TIFF file')
+        tags = dict()
+        for i in range(n_entries):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            tag, value_type = struct.unpack(byteorder + 'HH', entry[:4])
+            count, = struct.unpack(byteorder + value_count_fmt, entry[4:entry_size - offset_size])
+            value_fmt = TIFF_TAG_TYPES.get(value_type)
+            if value_fmt is None:
+                continue
+            value_size = struct.calcsize(value_fmt) * count
+            value = entry[entry_size - offset_size:]
+            if value_size > offset_size:
+                # corrupt counts and offsets must not make it read or allocate past file end
+                value_offset, = struct.unpack(byteorder + offset_fmt, value)
+                if value_offset + value_size > file_size:
+                    raise ValueError('TIFF tag value out of file')
+                position = f.tell()
+                f.seek(value_offset)
+                value = f.read(value_size)
+                f.seek(position)
+            if value_type == 2:
+                tags[tag] = value[:count].rstrip(b'\x00').decode('ascii', errors='replace')
+            else:
+                tags[tag] = struct.unpack(byteorder + value_fmt * count, value[:value_size])
+        ifds.append(tags)
+        ifd_offset, = struct.unpack(byteorder + offset_fmt, next_offset)
+    return ifds
 
 
-def _ndimage_to_file(ndimage, target_format):
-    if ndimage is None:
-        return None
-    ndimage = np.asarray(ndimage)
-    if ndimage.dtype == np.uint16:
-        ndimage = ndimage >> 8
-    ndimage = ndimage.astype(np.uint8)
-    tmp_file = tempfile.NamedTemporaryFile(suffix='.' + target_format)
-    try:
-        imread.imwrite(tmp_file.name, ndimage)
-    except Exception as e:
-        print(e)
-    return tmp_file
+def _read_tiff(f):
+    """
+    Read TIFF header and tags of all pages.
+    @param f: file object opened in binary mode, positioned at TIFF header
+    @return: (byteorder, list of {tag: values}) or (None, None) if not TIFF
+    """
+    header = f.read(4)
+    byteorder = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if byteorder is None:
+        return None, None
+    version, = struct.unpack(byteorder + 'H', header[2:4])
+    if version not in (42, 43):
+        return None, None
+    return byteorder, _read_tiff_ifds(f, byteorder, bigtiff=version == 43)
 
 
-def _get_n_frames(path):
+_TIFF_IFDS_CACHE = OrderedDict()
+_TIFF_IFDS_CACHE_LOCK = threading.Lock()
+
+
+def _read_tiff_cached(path):
+    """
+    Read TIFF header and tags of all pages, kept by file identity, since
+    stacks of thousands of pages take long to parse for every frame.
+    @param path: TIFF file path
+    @return: (byteorder, list of {tag: values}) or (None, None) if not TIFF
+    """
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        identity = (stat.st_size, stat.st_mtime_ns)
+        with _TIFF_IFDS_CACHE_LOCK:
+            entry = _TIFF_IFDS_CACHE.get(path)
+            if entry is not None and entry[0] == identity:
+                _TIFF_IFDS_CACHE.move_to_end(path)
+                return entry[1]
+        result = _read_tiff(f)
+    with _TIFF_IFDS_CACHE_LOCK:
+        _TIFF_IFDS_CACHE[path] = (identity, result)
+        while len(_TIFF_IFDS_CACHE) > TIFF_IFDS_CACHE_SIZE:
+            _TIFF_IFDS_CACHE.popitem(last=False)
+    return result
+
+
+def _read_tiff_frames(path):
+    """
+    Expose frames of uncompressed strip-based TIFF file as views of
+    single numpy.memmap, so subsampling touches only the pages it needs.
+    @param path: TIFF file path
+    @return: list of frames or None if file has to be decoded
+    """
     try:
-        frames = imread.imread_multi(path)
-        return len(frames)
-    except Exception:
-        return 1
+        byteorder, ifds = _read_tiff_cached(path)
+    except (OSError, ValueError, struct.error):
+        return None
+    if byteorder is None:
+        return None
+
+    raw = None
+    frames = list()
+    for tags in ifds:
+        if tags.get(254, (0,))[0] & 1:
+            # reduced resolution copy of another page
+            continue
+        samples = tags.get(277, (1,))[0]
+        bits = set(tags.get(258, (1,)))
+        sample_format = set(tags.get(339, (1,)))
+        if (tags.get(259, (1,))[0] != 1
+                or tags.get(262, (1,))[0] not in (1, 2)
+                or (samples > 1 and tags.get(284, (1,))[0] != 1)
+                or 322 in tags
+                or len(bits) != 1
+                or len(sample_format) != 1
+                or 273 not in tags):
+            return None
+        dtype = TIFF_SAMPLE_DTYPES.get((sample_format.pop(), bits.pop()))
+        if dtype is None:
+            return None
+        dtype = np.dtype(dtype).newbyteorder(byteorder)
+        height, width = tags[257][0], tags[256][0]
+        rows_per_strip = min(tags.get(278, (height,))[0], height)
+        strip_size = rows_per_strip * width * samples * dtype.itemsize
+        offsets = tags[273]
+        if any(offset != offsets[0] + i * strip_size for i, offset in enumerate(offsets)):
+            return None
+        shape = (height, width) if samples == 1 else (height, width, samples)
+        if raw is None:
+            raw = np.memmap(path, dtype=np.uint8, mode='r')
+        frame_size = height * width * samples * dtype.itemsize
+        if offsets[0] + frame_size > raw.size:
+            return None
+        frames.append(np.ndarray(shape, dtype, buffer=raw, offset=offsets[0]))
+
+        # ImageJ writes only the first page header of big stacks,
+        # the remaining frames follow it contiguously
+        description = tags.get(270, '')
+        if len(ifds) == 1 and isinstance(description, str) and description.startswith('ImageJ='):
+            n_images = [int(line.split('=')[1]) for line in description.splitlines()
+                        if line.startswith('images=') and line.split('=')[1].isdigit()]
+            if n_images:
+                n_images = min(n_images[0], (raw.size - offsets[0]) // frame_size)
+                frames.extend(np.ndarray(shape, dtype, buffer=raw, offset=offsets[0] + i * frame_size)
+                              for i in range(1, n_images))
+    return frames or None
+
+
+def _read_jpeg_size(f):
+    f.seek(2)
+    orientation = 1
+    while True:
+        marker = f.read(2)
+        while len(marker) == 2 and marker[0] == 0xFF and marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            continue
+        length, = struct.unpack('>H', f.read(2))
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>xHH', f.read(5))
+            # browsers apply EXIF orientation, rotated photos swap dimensions
+            if orientation >= 5:
+                width, height = height, width
+            return width, height
+        segment = f.read(length - 2)
+        if code == 0xE1 and segment[:6] == b'Exif\x00\x00':
+            try:
+                _, ifds = _read_tiff(io.BytesIO(segment[6:]))
+                orientation = ifds[0].get(274, (1,))[0] if ifds else 1
+            except (ValueError, struct.error):
+                pass
 
 
-def _get_preview(path, min_height, frame_ind=0):
+def _read_image_size(path):
+    """
+    Read pixel dimensions from image file header without decoding it.
+    @param path: image file path
+    @return: (width, height) or None if not recognized
+    """
     try:
-        ext = path.rsplit('.')[-1].lower()
-        if (MEDIA_EXTENSIONS.get(ext) == MediaTypes.IMAGE
-                and os.path.isfile(path)):
-            if ext in PREPROCESSED_MEDIA_TYPES:
-                if not IMREAD_ENABLED:
-                    print(IMREAD_NOT_ENABLED_MSG)
-                    return open(path, 'rb')
-                thumbnail = _get_thumbnail(path, min_height, frame_ind)
-                target_format = 'jpg'
-                return _ndimage_to_file(thumbnail, target_format)
-            else:
-                return open(path, 'rb')
-    except OSError:
+        with open(path, 'rb') as f:
+            head = f.read(32)
+            if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+                return struct.unpack('>II', head[16:24])
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                return struct.unpack('<HH', head[6:10])
+            if head[:2] == b'BM':
+                width, height = struct.unpack('<ii', head[18:26])
+                return width, abs(height)
+            if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                if head[12:16] == b'VP8 ':
+                    width, height = struct.unpack('<HH', head[26:30])
+                    return width & 0x3FFF, height & 0x3FFF
+                if head[12:16] == b'VP8L':
+                    bits, = struct.unpack('<I', head[21:25])
+                    return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+                if head[12:16] == b'VP8X':
+                    return (int.from_bytes(head[24:27], 'little') + 1,
+                            int.from_bytes(head[27:30], 'little') + 1)
+            if head[:4] in (b'\x00\x00\x01\x00', b'\x00\x00\x02\x00'):
+                return head[6] or 256, head[7] or 256
+            if head[:2] == b'\xff\xd8':
+                return _read_jpeg_size(f)
+            if head[:2] in (b'II', b'MM'):
+                f.seek(0)
+                _, ifds = _read_tiff(f)
+                if ifds and 256 in ifds[0] and 257 in ifds[0]:
+                    return ifds[0][256][0], ifds[0][257][0]
+    except (OSError, ValueError, struct.error):
         pass
     return None
 
 
-def get_dirs_list_html(dirs_list):
-    r = list()
-    dirs_list.insert(0, "..")
-    for fullname in dirs_list:
-        name = os.path.basename(fullname)
-        display_name = link_name = name
-        # Append / for directories or @ for symbolic links
-        if os.path.isdir(fullname):
-            display_name = name + "/"
-            link_name = name + "/"
-        if os.path.islink(fullname):
-            display_name = name + "@"
-            # Note: a link to a directory displays with @ and links with /
-        r.append('<li class="dir"><a href="{href}">{text}</a></li>'.format(
-            href=urllib.parse.quote(link_name, errors='surrogatepass'),
-            text=html.escape(display_name, quote=False)))
-    return "\n".join(r)
+def _read_frames(image_path):
+    frames = None
+    if image_path.rsplit('.')[-1].lower() in PREPROCESSED_MEDIA_TYPES:
+        frames = _read_tiff_frames(image_path)
+    if frames is None:
+        frames = imread.imread_multi(image_path)
+    return frames
 
 
-class MetaApi:
-    def __init__(self, root_path):
-        if os.path.isdir(root_path):
-            self.root_path = root_path
-        else:
-            self.root_path = os.curdir
+def _get_subsample(height, min_height):
+    return max(1, math.floor(height / min_height))
 
-    @staticmethod
-    def call(method=None, **kwargs):
-        """
-        Calling api method by name.
-        @param method: method name (check help method)
-        @param kwargs: named arguments dictionary for method
-        @return: (result, HTTPStatus)
-        """
-        if type(method) is str \
-                and method != "call" \
-                and not method.startswith("_") \
-                and hasattr(MetaApi, method):
-            try:
-                return getattr(META_API, method)(**kwargs)
-            except TypeError:
-                doc, _ = MetaApi.help(method)
-                return doc, HTTPStatus.BAD_REQUEST
-        return MetaApi.help(**kwargs)
 
-    @staticmethod
-    def help(on=None):
-        """
-        Api help. Specify method for detailed help.
-        @param on: one of possible methods {methods}
-        """
-        def prepare_doc(doc=None):
-            if doc is None:
-                doc = "No documentation."
-            return doc.replace("\n        ", " ")
-        all_methods = [f for f in dir(MetaApi) if not f.startswith('_')]
-        if on not in all_methods:
-            return prepare_doc(MetaApi.help.__doc__.format(methods=all_methods)), HTTPStatus.OK
-        return prepare_doc(getattr(MetaApi, on).__doc__), HTTPStatus.OK
+def _subsample_frame(img, min_height):
+    shape = img.shape
+    subsample = _get_subsample(shape[0], min_height)
+    if len(shape) == 2:
+        return img[::subsample, ::subsample]
+    elif len(shape) == 3:
+        return img[::subsample, ::subsample, :]
+    return None
 
-    def list_directory(self, path=None, only_files=None):
-        """
+
+def _get_thumbnail(image_path, min_height, frame_ind):
+    _, thumbnails = _get_frame_thumbnails(image_path, [frame_ind], min_height)
+    return thumbnails.get(frame_ind)
+
+
+def _to_uint8(ndimage):
+    ndimage = np.asarray(ndimage)
+    # kind and size are checked, so memory-mapped big-endian samples are scaled too
+    if ndimage.dtype.kind == 'u' and ndimage.dtype.itemsize == 2:
+        ndimage = ndimage >> 8
+    return ndimage.astype(np.uint8)
+
+
+def _get_encodable_formats():
+    if PIL_ENABLED:
+        return [fmt for fmt, pil_format in PIL_IMAGE_FORMATS.items() if pil_format in Image.SAVE]
+    return ['jpg']
+
+
+def _negotiate_image_format(accept):
+    """
+    Generated images format: first of THUMBNAIL_FORMATS, which client lists
+    in Accept header and which can be encoded, JPEG otherwise. Wildcards
+    don't count, browsers send image/* even without AVIF or WebP support.
+    @param accept: Accept header value
+    @return: format extension
+    """
+    accepted = set()
+    for item in accept.split(','):
+        media_type, *media_params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in media_params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    # JPEG fallback is always safe, unlike format client may not accept
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(media_type.lower())
+    encodable = _get_encodable_formats()
+    for fmt in THUMBNAIL_FORMATS:
+        if fmt in encodable and (fmt == 'jpg' or IMAGE_FORMAT_TYPES.get(fmt) in accepted):
+            return fmt
+    return 'jpg'
+
+
+def _write_image(path, ndimage, target_format):
+    if ndimage.ndim == 3 and (ndimage.shape[2] < 3 or target_format == 'jpg'):
+        # PIL has no modes for 2 channels, JPEG has no alpha
+        ndimage = ndimage[:, :, 0] if ndimage.shape[2] < 3 else ndimage[:, :, :3]
+    if PIL_ENABLED:
+        options = {'quality': THUMBNAIL_QUALITY}
+        if target_format == 'jpg':
+            options.update(progressive=THUMBNAIL_PROGRESSIVE, optimize=True)
+        Image.fromarray(np.ascontiguousarray(ndimage)).save(path, PIL_IMAGE_FORMATS[target_format], **options)
+    else:
+        imread.imwrite(path, ndimage, opts={'jpeg:quality': THUMBNAIL_QUALITY})
+
+
+def _ndimage_to_file(ndimage, target_format, cache_path=None):
+    if ndimage is None:
+        return None
+    ndimage = _to_uint8(ndimage)
+    if cache_path is None:
+        tmp_file = tempfile.NamedTemporaryFile(suffix='.' + target_format)
+        try:
+            _write_image(tmp_file.name, ndimage, target_format)
+        except Exception as e:
+            print(e)
+            tmp_file.close()
+            return None
+        return tmp_file
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.' + target_format, dir=cache_dir)
+    os.close(fd)
+    try:
+        _write_image(tmp_path, ndimage, target_format)
+        # rename is atomic, so readers never see partially written entry
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(e)
+        os.remove(tmp_path)
+        return None
+    return open(cache_path, 'rb')
+
+
+class _LruCache:
+    """
+    Thread-safe LRU cache bounded by total size of values in bytes.
+    Insertion and eviction never wait for lock: when cache is busy
+    new value is just not cached.
+    """
+    def __init__(self, max_size, max_item_size=None):
+        self.max_size = max_size
+        self.max_item_size = max_size // 8 if max_item_size is None else max_item_size
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.skipped = 0
+        # puts are skipped when main lock is busy, so their count has its own
+        self.skipped_lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size=None):
+        size = len(value) if size is None else size
+        if size > self.max_item_size:
+            return
+        if not self.lock.acquire(blocking=False):
+            with self.skipped_lock:
+                self.skipped += 1
+            return
+        try:
+            previous = self.items.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        with self.skipped_lock:
+            skipped = self.skipped
+        with self.lock:
+            return {'max_size': self.max_size,
+                    'size': self.size,
+                    'items': len(self.items),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'skipped': skipped}
+
+
+MEMORY_CACHE = _LruCache(MEMORY_CACHE_SIZE)
+FRAME_CACHE = _LruCache(FRAME_CACHE_SIZE)
+
+
+def _get_content_key(path):
+    """
+    Key of file content for caches of generated images, which outlive the
+    process and are shared by workers. Files share it only when hash of
+    their whole content is known, then duplicates share generated images.
+    Otherwise it is made of path, size and modification time, since sampled
+    fingerprint doesn't change when file is edited in place.
+    """
+    identity = _get_file_identity(path)
+    _get_file_meta(path)
+    with _METADATA_CACHE_LOCK:
+        entry = _METADATA_CACHE.get(path)
+        digest = entry[2] if entry is not None and entry[0] == identity else None
+    return _format_content_key(path, identity, digest)
+
+
+def _format_content_key(path, identity, digest):
+    if digest is not None:
+        return '{:x}-{}'.format(identity[0], digest)
+    return '\0'.join(str(el) for el in (os.path.abspath(path),) + identity)
+
+
+def _get_cache_key(path, target_format, *params):
+    """
+    Key of generated image in thumbnail caches.
+    Entry is keyed by content key of source file and generation
+    parameters, so modified files are not served stale and verified
+    duplicate files share entries.
+    """
+    key = '\0'.join(str(el) for el in (_get_content_key(path), target_format) + params)
+    return hashlib.sha1(key.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def _get_cache_path(key, target_format):
+    """
+    Location of generated image in on-disk thumbnail cache.
+    @return: cache file path or None if cache is disabled
+    """
+    if not THUMBNAIL_CACHE_DIR:
+        return None
+    return os.path.join(THUMBNAIL_CACHE_DIR, key[:2], key + '.' + target_format)
+
+
+def _prepare_cache_dir(cache_dir):
+    """
+    Create thumbnail cache directory accessible only by current user, or
+    check that existing one is owned by current user and is not writable
+    by others, since its entries are served without further checks.
+    @return: True if directory can be used as cache
+    """
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        stat = os.stat(cache_dir)
+    except OSError as e:
+        print(e)
+        return False
+    if hasattr(os, 'getuid') and (stat.st_uid != os.getuid() or stat.st_mode & 0o022):
+        print('WARNING: thumbnail cache directory {path} is not owned by current user or is writable '
+              'by others, cache is disabled.'.format(path=cache_dir))
+        return False
+    return True
+
+
+_CACHE_WRITTEN = 0
+_CACHE_WRITTEN_LOCK = threading.Lock()
+
+
+def _touch_cache_entry(cache_path):
+    """
+    Mark on-disk cache entry as recently used, trimming removes entries
+    by modification time.
+    """
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+
+
+def _note_cache_write(size):
+    """
+    Count bytes written to on-disk cache and trim it in background
+    each time CACHE_TRIM_INTERVAL of its limit is written.
+    """
+    global _CACHE_WRITTEN
+    if THUMBNAIL_CACHE_MAX_SIZE <= 0:
+        return
+    with _CACHE_WRITTEN_LOCK:
+        _CACHE_WRITTEN += size
+        if _CACHE_WRITTEN < THUMBNAIL_CACHE_MAX_SIZE * CACHE_TRIM_INTERVAL:
+            return
+        _CACHE_WRITTEN = 0
+    threading.Thread(target=_trim_cache, daemon=True).start()
+
+
+def _trim_cache():
+    """
+    Remove least recently used entries of on-disk cache until it takes
+    CACHE_TRIM_TARGET of THUMBNAIL_CACHE_MAX_SIZE. Worker processes may
+    trim at the same time, entries already removed are skipped.
+    """
+    entries = []
+    total = 0
+    for root, _, names in os.walk(THUMBNAIL_CACHE_DIR):
+        for name in names:
+            # temporary files of entries being written
+            if name.startswith(tempfile.gettempprefix()):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    target = THUMBNAIL_CACHE_MAX_SIZE * CACHE_TRIM_TARGET
+    for _, size, path in sorted(entries):
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _get_generated_image(path, target_format, params, generate):
+    """
+    Generated image (thumbnail, tile, sprite) of source file taken from
+    memory cache, then from on-disk cache, then made by generate().
+    @param path: source file path
+    @param target_format: generated image format
+    @param params: tuple of generation parameters
+    @param generate: function returning ndimage or None
+    @return: file object or None
+    """
+    key = _get_cache_key(path, target_format, THUMBNAIL_QUALITY, THUMBNAIL_PROGRESSIVE, *params)
+    data = MEMORY_CACHE.get(key)
+    if data is not None:
+        _set_cache_status('memory')
+        return io.BytesIO(data)
+    cache_path = _get_cache_path(key, target_format)
+    if cache_path is not None and os.path.isfile(cache_path):
+        _set_cache_status('disk')
+        f = open(cache_path, 'rb')
+        _touch_cache_entry(cache_path)
+    else:
+        _set_cache_status('miss')
+        f = _ndimage_to_file(generate(), target_format, cache_path)
+        if f is None:
+            return None
+        if cache_path is not None:
+            _note_cache_write(os.fstat(f.fileno()).st_size)
+    data = f.read(MEMORY_CACHE.max_item_size + 1)
+    if not data:
+        # never cache or serve result of failed encoding as an empty image
+        f.close()
+        return None
+    if len(data) > MEMORY_CACHE.max_item_size:
+        f.seek(0)
+        return f
+    f.close()
+    MEMORY_CACHE.put(key, data)
+    return io.BytesIO(data)
+
+
+_FRAME_READ_LOCKS = [threading.Lock() for _ in range(16)]
+_READAHEAD_QUEUE = queue.Queue(FRAME_READAHEAD_QUEUE_SIZE)
+_READAHEAD_WORKER = None
+
+
+def _compact_frame(img):
+    """
+    Frame subsampled to the largest thumbnail size and converted to uint8
+    for decoded-frame cache, copied so it doesn't keep source memory mapped.
+    """
+    return np.ascontiguousarray(_to_uint8(_subsample_frame(img, max(THUMBNAIL_SIZES))))
+
+
+def _subsample_compact_frame(compact, shape, min_height):
+    """
+    Subsample compact frame like _subsample_frame subsamples its source:
+    rows and columns nearest to the source ones are picked, so thumbnail
+    has the same size whether it is cut from cache or from source.
+    @param compact: frame made by _compact_frame
+    @param shape: (height, width) of source frame
+    @param min_height: thumbnail height
+    """
+    height, width = shape
+    compact_subsample = _get_subsample(height, max(THUMBNAIL_SIZES))
+    subsample = _get_subsample(height, min_height)
+    rows = np.arange(0, height, subsample) // compact_subsample
+    columns = np.arange(0, width, subsample) // compact_subsample
+    return compact[np.ix_(rows, columns)]
+
+
+def _find_frame_thumbnails(content_key, frame_inds, min_height):
+    info = FRAME_CACHE.get((content_key, 'frames'))
+    if info is None:
+        return None, None
+    shapes = info[0]
+    thumbnails = dict()
+    for frame_ind in frame_inds:
+        if 0 <= frame_ind < len(shapes):
+            compact = FRAME_CACHE.get((content_key, frame_ind))
+            if compact is None:
+                return None, None
+            thumbnails[frame_ind] = _subsample_compact_frame(compact, shapes[frame_ind], min_height)
+    return info, thumbnails
+
+
+def _read_frame_thumbnails(path, content_key, frame_inds, min_height, cache_mapped):
+    """
+    Read file once for frames missing in decoded-frame cache. imread decodes
+    all frames at once, so compact copies of all of them are cached, the
+    requested ones last, so they are evicted last. Memory-mapped TIFF frames
+    cost nothing until they are touched, they are cached only if cache_mapped.
+    @return: ((source shapes, True if memory-mapped), {frame_ind: thumbnail})
+    """
+    frames = None
+    if path.rsplit('.')[-1].lower() in PREPROCESSED_MEDIA_TYPES:
+        frames = _read_tiff_frames(path)
+    mapped = frames is not None
+    if not mapped:
+        frames = imread.imread_multi(path)
+    info = ([frame.shape[:2] for frame in frames], mapped)
+    FRAME_CACHE.put((content_key, 'frames'), info, 64 * len(frames))
+    wanted = [frame_ind for frame_ind in frame_inds if 0 <= frame_ind < len(frames)]
+    thumbnails = dict()
+    if mapped and not cache_mapped:
+        for frame_ind in wanted:
+            thumbnails[frame_ind] = _to_uint8(_subsample_frame(frames[frame_ind], min_height))
+        return info, thumbnails
+    order = wanted
+    if not mapped:
+        others = set(range(len(frames))).difference(wanted)
+        order = sorted(others, key=lambda i: -abs(i - wanted[0]) if wanted else 0) + wanted
+    for frame_ind in order:
+        compact = FRAME_CACHE.get((content_key, frame_ind)) if mapped else None
+        if compact is None:
+            compact = _compact_frame(frames[frame_ind])
+            FRAME_CACHE.put((content_key, frame_ind), compact, compact.nbytes)
+        thumbnails[frame_ind] = compact
+    return info, {frame_ind: _subsample_compact_frame(thumbnails[frame_ind], info[0][frame_ind], min_height)
+                  for frame_ind in wanted}
+
+
+def _readahead_worker():
+    while True:
+        path, frame_ind = _READAHEAD_QUEUE.get()
+        try:
+            _get_frame_thumbnails(path, range(frame_ind - FRAME_READAHEAD, frame_ind + FRAME_READAHEAD + 1),
+                                  max(THUMBNAIL_SIZES))
+        except Exception:
+            pass
+
+
+def _get_frame_thumbnails(path, frame_inds, min_height, cache_mapped=True):
+    """
+    Thumbnails of image frames for previews and sprites, cut from compact
+    copies of frames (uint8, subsampled to the largest thumbnail size) kept
+    in FRAME_CACHE, so stepping through frames and making sprites don't read
+    file again. Neighbours of memory-mapped frame requested alone are read
+    ahead in background.
+    @param path: image path
+    @param frame_inds: frame indices, those out of range are skipped
+    @param min_height: thumbnail height, at most the largest thumbnail size
+    @param cache_mapped: cache compact copies of requested memory-mapped frames
+    @return: (source (height, width) of every frame, {frame_ind: thumbnail})
+    """
+    global _READAHEAD_WORKER
+    content_key = _get_content_key(path)
+    info, thumbnails = _find_frame_thumbnails(content_key, frame_inds, min_height)
+    if info is None:
+        # concurrent requests of a new file wait for single read of it
+        with _FRAME_READ_LOCKS[hash(content_key) % len(_FRAME_READ_LOCKS)]:
+            info, thumbnails = _find_frame_thumbnails(content_key, frame_inds, min_height)
+            if info is None:
+                info, thumbnails = _read_frame_thumbnails(path, content_key, frame_inds, min_height, cache_mapped)
+    shapes, mapped = info
+    if mapped and cache_mapped and len(frame_inds) == 1 and len(shapes) > 1 and FRAME_CACHE.max_size > 0:
+        frame_ind = frame_inds[0]
+        if any((content_key, i) not in FRAME_CACHE
+               for i in (frame_ind - 1, frame_ind + 1) if 0 <= i < len(shapes)):
+            if _READAHEAD_WORKER is None:
+                _READAHEAD_WORKER = threading.Thread(target=_readahead_worker, daemon=True)
+                _READAHEAD_WORKER.start()
+            try:
+                _READAHEAD_QUEUE.put_nowait((path, frame_ind))
+            except queue.Full:
+                pass
+    return shapes, thumbnails
+
+
+def _parse_thumbnail_sizes(value):
+    """
+    Parse comma separated thumbnail heights of command line.
+    """
+    try:
+        sizes = [int(size) for size in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('thumbnail sizes must be comma separated integers')
+    if any(size <= 0 for size in sizes):
+        raise argparse.ArgumentTypeError('thumbnail sizes must be positive')
+    return sizes
+
+
+def _snap_thumbnail_size(min_height):
+    """
+    Snap requested thumbnail height to the smallest size bucket not less
+    than it, so clients with different screens share cached thumbnails.
+    """
+    for size in sorted(THUMBNAIL_SIZES):
+        if size >= min_height:
+            return size
+    return max(THUMBNAIL_SIZES)
+
+
+def _get_n_frames(path):
+    try:
+        shapes, _ = _get_frame_thumbnails(path, [], max(THUMBNAIL_SIZES))
+        return len(shapes)
+    except Exception:
+        return 1
+
+
+def _get_preview(path, min_height, frame_ind=0, target_format='jpg'):
+    try:
+        ext = path.rsplit('.')[-1].lower()
+        if (MEDIA_EXTENSIONS.get(ext) == MediaTypes.IMAGE
+                and os.path.isfile(path)):
+            if ext in PREPROCESSED_MEDIA_TYPES:
+                if not IMREAD_ENABLED:
+                    print(IMREAD_NOT_ENABLED_MSG)
+                    return open(path, 'rb')
+                def generate():
+                    thumbnail = _get_thumbnail(path, min_height, frame_ind)
+                    if thumbnail is not None and frame_ind == 0:
+                        _set_placeholder(path, _get_file_identity(path), _get_placeholder_color(thumbnail))
+                    return thumbnail
+                return _get_generated_image(path, target_format, ('thumbnail', min_height, frame_ind), generate)
+            else:
+                return open(path, 'rb')
+    except OSError:
+        pass
+    return None
+
+
+class _ImagePyramid:
+    """
+    Deep-zoom pyramid over single decoded frame.
+    Level max_level is full resolution, every lower level halves it,
+    level 0 fits into a single tile. Levels are strided views of the
+    decoded frame, so they are built lazily and cost no extra memory.
+    """
+    def __init__(self, frame):
+        self.frame = frame
+        self.height, self.width = frame.shape[:2]
+        self.max_level = max(0, math.ceil(math.log2(max(self.height, self.width) / TILE_SIZE)))
+
+    def info(self):
+        return {'width': self.width,
+                'height': self.height,
+                'tile_size': TILE_SIZE,
+                'max_level': self.max_level}
+
+    def get_tile(self, level, x, y):
+        if not 0 <= level <= self.max_level:
+            return None
+        scale = 2 ** (self.max_level - level)
+        span = TILE_SIZE * scale
+        x0, y0 = x * span, y * span
+        if x < 0 or y < 0 or x0 >= self.width or y0 >= self.height:
+            return None
+        return self.frame[y0:y0 + span:scale, x0:x0 + span:scale]
+
+
+_PYRAMID_CACHE = OrderedDict()
+_PYRAMID_CACHE_LOCK = threading.Lock()
+_PYRAMID_BUILD_LOCK = threading.Lock()
+
+
+def _get_pyramid(image_path, frame_ind):
+    key = (image_path, os.stat(image_path).st_mtime_ns, frame_ind)
+    with _PYRAMID_CACHE_LOCK:
+        if key in _PYRAMID_CACHE:
+            _PYRAMID_CACHE.move_to_end(key)
+            return _PYRAMID_CACHE[key]
+    # tiles of a new image are requested in a burst, decode it only once
+    with _PYRAMID_BUILD_LOCK:
+        with _PYRAMID_CACHE_LOCK:
+            if key in _PYRAMID_CACHE:
+                return _PYRAMID_CACHE[key]
+        frames = _read_frames(image_path)
+        pyramid = None
+        if 0 <= frame_ind < len(frames):
+            pyramid = _ImagePyramid(frames[frame_ind])
+        with _PYRAMID_CACHE_LOCK:
+            _PYRAMID_CACHE[key] = pyramid
+            while len(_PYRAMID_CACHE) > PYRAMID_CACHE_SIZE:
+                _PYRAMID_CACHE.popitem(last=False)
+        return pyramid
+
+
+def _get_tile(path, level, x, y, frame_ind=0, target_format='jpg'):
+    try:
+        ext = path.rsplit('.')[-1].lower()
+        if (ext in PREPROCESSED_MEDIA_TYPES
+                and IMREAD_ENABLED
+                and os.path.isfile(path)):
+            def generate():
+                pyramid = _get_pyramid(path, frame_ind)
+                return None if pyramid is None else pyramid.get_tile(level, x, y)
+            return _get_generated_image(path, target_format, ('tile', level, x, y, frame_ind), generate)
+    except Exception:
+        pass
+    return None
+
+
+def _get_sprite_layout(shapes, min_height, start, stop):
+    """
+    Grid layout of frame thumbnails packed into single sprite image.
+    @param shapes: (height, width) of every frame
+    Frames are placed row by row into equal cells of nearly square grid.
+    Sprite ends early when it would exceed SPRITE_MAX_PIXELS, the rest
+    of range is left to the next sprite starting at returned stop.
+    @return: layout dictionary (also served as JSON offsets map) or None
+    """
+    stop = min(len(shapes), stop, start + SPRITE_MAX_FRAMES)
+    cells = list()
+    cell_height = cell_width = 0
+    for frame_ind in range(max(0, start), stop):
+        height, width = shapes[frame_ind]
+        subsample = _get_subsample(height, min_height)
+        cell = (frame_ind, -(-height // subsample), -(-width // subsample))
+        columns = math.ceil(math.sqrt(len(cells) + 1))
+        rows = math.ceil((len(cells) + 1) / columns)
+        if cells and (rows * max(cell_height, cell[1])) * (columns * max(cell_width, cell[2])) > SPRITE_MAX_PIXELS:
+            break
+        cells.append(cell)
+        cell_height = max(cell_height, cell[1])
+        cell_width = max(cell_width, cell[2])
+    if len(cells) == 0:
+        return None
+    columns = math.ceil(math.sqrt(len(cells)))
+    return {'frames_count': len(shapes),
+            'start': cells[0][0],
+            'stop': cells[-1][0] + 1,
+            'min_height': min_height,
+            'columns': columns,
+            'rows': math.ceil(len(cells) / columns),
+            'cell_width': cell_width,
+            'cell_height': cell_height,
+            'frames': [{'frame_ind': frame_ind,
+                        'x': (i % columns) * cell_width,
+                        'y': (i // columns) * cell_height,
+                        'width': width,
+                        'height': height}
+                       for i, (frame_ind, height, width) in enumerate(cells)]}
+
+
+def _make_sprite(layout, frame_thumbnails):
+    """
+    Pack frame thumbnails into sprite image.
+    @param layout: layout made by _get_sprite_layout
+    @param frame_thumbnails: thumbnails of frames of layout in its order
+    """
+    if layout is None:
+        return None
+    thumbnails = list()
+    for cell, img in zip(layout['frames'], frame_thumbnails):
+        img = _to_uint8(img)
+        if img.ndim == 2:
+            img = img[:, :, np.newaxis]
+        # grey with alpha is kept grey, alpha is dropped
+        thumbnails.append((cell, img[:, :, :1] if img.shape[2] == 2 else img[:, :, :3]))
+    channels = max(img.shape[2] for _, img in thumbnails)
+    sprite = np.zeros((layout['rows'] * layout['cell_height'],
+                       layout['columns'] * layout['cell_width'],
+                       channels), dtype=np.uint8)
+    for cell, img in thumbnails:
+        sprite[cell['y']:cell['y'] + cell['height'], cell['x']:cell['x'] + cell['width'], :] = img
+    if channels == 1:
+        sprite = sprite[:, :, 0]
+    return sprite
+
+
+def _get_sprite(path, min_height, start, stop, target_format='jpg'):
+    try:
+        ext = path.rsplit('.')[-1].lower()
+        if (ext in PREPROCESSED_MEDIA_TYPES
+                and IMREAD_ENABLED
+                and os.path.isfile(path)):
+            def generate():
+                shapes, _ = _get_frame_thumbnails(path, [], min_height)
+                layout = _get_sprite_layout(shapes, min_height, start, stop)
+                if layout is None:
+                    return None
+                frame_inds = [cell['frame_ind'] for cell in layout['frames']]
+                # frames not cached are subsampled right from memory map, not compacted
+                _, thumbnails = _get_frame_thumbnails(path, frame_inds, min_height, cache_mapped=False)
+                return _make_sprite(layout, [thumbnails[frame_ind] for frame_ind in frame_inds])
+            return _get_generated_image(path, target_format, ('sprite', min_height, start, stop), generate)
+    except Exception:
+        pass
+    return None
+
+
+def _get_placeholder_color(ndimage):
+    """
+    Average colour of image as '#rrggbb', used as placeholder while thumbnail loads.
+    """
+    height, width = ndimage.shape[:2]
+    step = max(1, height // PLACEHOLDER_SAMPLES, width // PLACEHOLDER_SAMPLES)
+    sample = _to_uint8(ndimage[::step, ::step])
+    if sample.ndim == 2 or sample.shape[2] < 3:
+        sample = sample.reshape(sample.shape[0], sample.shape[1], -1)[:, :, :1].repeat(3, axis=2)
+    color = sample[:, :, :3].reshape(-1, 3).mean(axis=0)
+    return '#' + ''.join('{:02x}'.format(int(round(c))) for c in color)
+
+
+_METADATA_CACHE = OrderedDict()
+_METADATA_CACHE_LOCK = threading.Lock()
+# path -> identity of files waiting for placeholder, newest last
+_PLACEHOLDER_QUEUE = OrderedDict()
+_PLACEHOLDER_QUEUE_CHANGED = threading.Condition(_METADATA_CACHE_LOCK)
+_PLACEHOLDER_WORKER = None
+# path -> identity of files whose sampled fingerprint collided, newest last
+_FINGERPRINT_QUEUE = OrderedDict()
+_FINGERPRINT_QUEUE_CHANGED = threading.Condition(_METADATA_CACHE_LOCK)
+_FINGERPRINT_WORKER = None
+
+
+def _queue_placeholder(path, identity):
+    """
+    Queue file for placeholder decoding. Must be called with
+    _METADATA_CACHE_LOCK held. Queue is bounded and newest requests are
+    served first, as they come from listing pages client looks at now;
+    the oldest ones are dropped together with their metadata, so file is
+    queued again if it's listed again.
+    """
+    _PLACEHOLDER_QUEUE[path] = identity
+    _PLACEHOLDER_QUEUE.move_to_end(path)
+    if len(_PLACEHOLDER_QUEUE) > PLACEHOLDER_QUEUE_SIZE:
+        dropped, dropped_identity = _PLACEHOLDER_QUEUE.popitem(last=False)
+        entry = _METADATA_CACHE.get(dropped)
+        if entry is not None and entry[0] == dropped_identity and entry[1]['placeholder'] is None:
+            del _METADATA_CACHE[dropped]
+    _PLACEHOLDER_QUEUE_CHANGED.notify()
+
+
+def _placeholder_worker():
+    while True:
+        with _PLACEHOLDER_QUEUE_CHANGED:
+            _PLACEHOLDER_QUEUE_CHANGED.wait_for(lambda: _PLACEHOLDER_QUEUE)
+            path, identity = _PLACEHOLDER_QUEUE.popitem()
+        try:
+            color = _get_placeholder_color(_read_placeholder_image(path))
+        except Exception:
+            color = None
+        _set_placeholder(path, identity, color)
+
+
+def _read_placeholder_image(path):
+    """
+    Decode image for placeholder colour, reduced while decoding when Pillow
+    can do it (JPEG is decoded at down to 1/8 of its size).
+    """
+    if PIL_ENABLED:
+        try:
+            with Image.open(path) as img:
+                img.draft('RGB', (PLACEHOLDER_SAMPLES, PLACEHOLDER_SAMPLES))
+                # other modes (16-bit, float) are scaled by _to_uint8 from imread result
+                if img.mode in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                    return np.asarray(img.convert('RGB'))
+        except Exception:
+            pass
+    return imread.imread(path)
+
+
+def _get_placeholder_cache_path(path, identity, digest):
+    """
+    Location of placeholder colour in on-disk cache, so image decoded for it
+    once is not decoded again by other workers or after restart.
+    @return: cache file path or None if cache is disabled
+    """
+    key = '\0'.join((_format_content_key(path, identity, digest), 'placeholder'))
+    return _get_cache_path(hashlib.sha1(key.encode('utf-8', 'surrogatepass')).hexdigest(), 'placeholder')
+
+
+def _load_placeholder(cache_path):
+    if cache_path is None:
+        return None
+    try:
+        with open(cache_path) as f:
+            color = f.read(16)
+    except (OSError, UnicodeDecodeError):
+        return None
+    if len(color) != 7 or not color.startswith('#'):
+        return None
+    _touch_cache_entry(cache_path)
+    return color
+
+
+def _store_placeholder(cache_path, color):
+    if cache_path is None:
+        return
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.placeholder', dir=cache_dir)
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(color)
+        # rename is atomic, so readers never see partially written entry
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(e)
+        os.remove(tmp_path)
+        return
+    _note_cache_write(len(color))
+
+
+def _queue_fingerprint(path, identity):
+    """
+    Queue file for fingerprint verification. Must be called with
+    _METADATA_CACHE_LOCK held. Like placeholder queue it is bounded and
+    the oldest files are dropped together with their metadata.
+    """
+    _FINGERPRINT_QUEUE[path] = identity
+    _FINGERPRINT_QUEUE.move_to_end(path)
+    if len(_FINGERPRINT_QUEUE) > FINGERPRINT_QUEUE_SIZE:
+        dropped, dropped_identity = _FINGERPRINT_QUEUE.popitem(last=False)
+        entry = _METADATA_CACHE.get(dropped)
+        if entry is not None and entry[0] == dropped_identity and entry[1]['fingerprint'] is None:
+            del _METADATA_CACHE[dropped]
+    _FINGERPRINT_QUEUE_CHANGED.notify()
+
+
+def _fingerprint_worker():
+    while True:
+        with _FINGERPRINT_QUEUE_CHANGED:
+            _FINGERPRINT_QUEUE_CHANGED.wait_for(lambda: _FINGERPRINT_QUEUE)
+            path, identity = _FINGERPRINT_QUEUE.popitem()
+        try:
+            if _get_file_identity(path) != identity:
+                continue
+            fingerprint, digest = _verify_fingerprint(path, identity)
+        except OSError:
+            continue
+        with _METADATA_CACHE_LOCK:
+            entry = _METADATA_CACHE.get(path)
+            if entry is not None and entry[0] == identity:
+                entry[1]['fingerprint'] = fingerprint
+                _METADATA_CACHE[path] = entry[:2] + (digest,)
+
+
+def _set_placeholder(path, identity, color):
+    with _METADATA_CACHE_LOCK:
+        entry = _METADATA_CACHE.get(path)
+        if entry is None or entry[0] != identity or color is None or entry[1]['placeholder'] == color:
+            return
+        entry[1]['placeholder'] = color
+        digest = entry[2]
+    _store_placeholder(_get_placeholder_cache_path(path, identity, digest), color)
+
+
+def _set_content_digest(path, identity, digest):
+    with _METADATA_CACHE_LOCK:
+        entry = _METADATA_CACHE.get(path)
+        if entry is not None and entry[0] == identity:
+            _METADATA_CACHE[path] = entry[:2] + (digest,)
+
+
+def _get_file_identity(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _get_etag(path, *params):
+    """
+    Entity tag of file or of image generated from it with params.
+    """
+    size, mtime_ns = _get_file_identity(path)
+    etag = '{:x}-{:x}'.format(size, mtime_ns)
+    if params:
+        etag += '-' + hashlib.sha1(repr(params).encode('utf-8')).hexdigest()[:12]
+    return '"{}"'.format(etag)
+
+
+_FINGERPRINTS = OrderedDict()
+_FINGERPRINTS_LOCK = threading.Lock()
+
+
+def _hash_file(path, sampled=True):
+    """
+    SHA-1 of file content or only of FINGERPRINT_SAMPLES blocks spread over it.
+    @return: (hex digest, True if whole content was hashed)
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if sampled and size > FINGERPRINT_SAMPLES * FINGERPRINT_BLOCK_SIZE:
+            step = (size - FINGERPRINT_BLOCK_SIZE) // (FINGERPRINT_SAMPLES - 1)
+            for i in range(FINGERPRINT_SAMPLES):
+                f.seek(i * step)
+                digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+            return digest.hexdigest(), False
+        for block in iter(partial(f.read, 1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest(), True
+
+
+def _get_fingerprint(path, identity):
+    """
+    Content fingerprint of file: size and hash of sampled blocks. When
+    another file with the same fingerprint was seen, fingerprint of this
+    one is unknown until both are compared by full hash in background,
+    so equal fingerprints always mean byte-identical files.
+    @param path: file path
+    @param identity: (size, mtime) of file
+    @return: (fingerprint string or None, hash of whole content if it was computed,
+    True if file waits for verification), (None, None, False) if file can't be read
+    """
+    try:
+        digest, complete = _hash_file(path)
+        fingerprint = '{:x}-{}'.format(identity[0], digest)
+        if complete:
+            return fingerprint, digest, False
+        with _FINGERPRINTS_LOCK:
+            entry = _FINGERPRINTS.get(fingerprint)
+        if entry is not None and entry[:2] == (path, identity):
+            return fingerprint, entry[2], False
+        if entry is not None:
+            try:
+                is_current = _get_file_identity(entry[0]) == entry[1]
+            except OSError:
+                is_current = False
+            if is_current:
+                return None, None, True
+        # nothing was compared with the changed file yet, so this one takes its place
+        with _FINGERPRINTS_LOCK:
+            _FINGERPRINTS[fingerprint] = (path, identity, None)
+            while len(_FINGERPRINTS) > METADATA_CACHE_SIZE:
+                _FINGERPRINTS.popitem(last=False)
+        return fingerprint, None, False
+    except OSError:
+        return None, None, False
+
+
+def _verify_fingerprint(path, identity):
+    """
+    Compare file with the first file of the same sampled fingerprint by
+    full hash of both. File keeps sampled fingerprint if they are equal
+    and gets full hash fingerprint otherwise.
+    @return: (fingerprint, hash of whole content)
+    """
+    fingerprint = '{:x}-{}'.format(identity[0], _hash_file(path)[0])
+    full_digest = _hash_file(path, sampled=False)[0]
+    with _FINGERPRINTS_LOCK:
+        entry = _FINGERPRINTS.get(fingerprint)
+    if entry is not None and entry[2] is None:
+        try:
+            is_current = _get_file_identity(entry[0]) == entry[1]
+        except OSError:
+            is_current = False
+        if is_current:
+            # the first collision, first file is verified now
+            entry = entry[:2] + (_hash_file(entry[0], sampled=False)[0],)
+            _set_content_digest(entry[0], entry[1], entry[2])
+            with _FINGERPRINTS_LOCK:
+                _FINGERPRINTS[fingerprint] = entry
+        else:
+            entry = None
+    if entry is not None and entry[2] == full_digest:
+        return fingerprint, full_digest
+    return '{:x}-{}'.format(identity[0], full_digest), full_digest
+
+
+def _get_file_meta(path):
+    """
+    Metadata of file for directory listing: pixel dimensions of images
+    read from headers, placeholder colour and content fingerprint.
+    Placeholder is computed once, right away when it's cheap (memory-mapped
+    TIFF) or in background worker otherwise, so it appears in listings
+    after the first one; the decoded ones are kept in on-disk cache. So does fingerprint which needs verification.
+    @param path: file path
+    @return: {width, height, placeholder, fingerprint}, values are None if unknown
+    """
+    global _PLACEHOLDER_WORKER, _FINGERPRINT_WORKER
+    identity = _get_file_identity(path)
+    with _METADATA_CACHE_LOCK:
+        entry = _METADATA_CACHE.get(path)
+        if entry is not None and entry[0] == identity:
+            _METADATA_CACHE.move_to_end(path)
+            return dict(entry[1])
+
+    meta, decode_placeholder = _read_file_meta(path)
+    meta['fingerprint'], digest, verify = _get_fingerprint(path, identity)
+    if decode_placeholder:
+        meta['placeholder'] = _load_placeholder(_get_placeholder_cache_path(path, identity, digest))
+        decode_placeholder = meta['placeholder'] is None
+    with _METADATA_CACHE_LOCK:
+        # hash of whole content, when known, lets duplicates share generated images
+        _METADATA_CACHE[path] = (identity, meta, digest)
+        while len(_METADATA_CACHE) > METADATA_CACHE_SIZE:
+            evicted, _ = _METADATA_CACHE.popitem(last=False)
+            _PLACEHOLDER_QUEUE.pop(evicted, None)
+            _FINGERPRINT_QUEUE.pop(evicted, None)
+        if verify:
+            if _FINGERPRINT_WORKER is None:
+                _FINGERPRINT_WORKER = threading.Thread(target=_fingerprint_worker, daemon=True)
+                _FINGERPRINT_WORKER.start()
+            _queue_fingerprint(path, identity)
+        if decode_placeholder:
+            if _PLACEHOLDER_WORKER is None:
+                _PLACEHOLDER_WORKER = threading.Thread(target=_placeholder_worker, daemon=True)
+                _PLACEHOLDER_WORKER.start()
+            _queue_placeholder(path, identity)
+    return dict(meta)
+
+
+def _read_file_meta(path):
+    """
+    Read metadata of file without caching.
+    @return: (meta, True if placeholder needs full image decoding)
+    """
+    meta = {'width': None, 'height': None, 'placeholder': None}
+    ext = path.rsplit('.')[-1].lower()
+    decode_placeholder = False
+    if MEDIA_EXTENSIONS.get(ext) == MediaTypes.IMAGE:
+        size = _read_image_size(path)
+        if size is not None:
+            meta['width'], meta['height'] = size
+        frames = _read_tiff_frames(path) if ext in PREPROCESSED_MEDIA_TYPES else None
+        if frames is not None:
+            meta['placeholder'] = _get_placeholder_color(frames[0])
+        else:
+            decode_placeholder = IMREAD_ENABLED and size is not None
+    return meta, decode_placeholder
+
+
+def _scan_directory(path):
+    """
+    Single pass over directory, shared by gallery page and listing API.
+    @param path: directory path
+    @return: (sorted names of files, paths of subdirectories sorted case-insensitively)
+    """
+    files_list = []
+    dirs_list = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                # exported gallery data is not part of gallery
+                if entry.name != EXPORT_DIR_NAME:
+                    dirs_list.append(entry.path)
+            elif entry.is_file():
+                files_list.append(entry.name)
+    files_list.sort()
+    dirs_list.sort(key=lambda a: a.lower())
+    return files_list, dirs_list
+
+
+def _get_listing_page(path, names, limit=None):
+    """
+    Files with meta for listing page. Files removed since directory was
+    scanned are skipped and following names take their place, so page is
+    shorter than limit only at the end of listing, as client expects.
+    @param path: directory path
+    @param names: sorted names of files from the start of page on
+    @param limit: maximal number of files [default: all]
+    @return: list of {name, width, height, placeholder, fingerprint}
+    """
+    page = []
+    for name in names:
+        if limit is not None and len(page) >= limit:
+            break
+        try:
+            page.append(dict(name=name, **_get_file_meta(os.path.join(path, name))))
+        except OSError:
+            pass
+    return page
+
+
+def _get_preload_urls(listing):
+    """
+    Thumbnail URLs of first PRELOAD_THUMBNAILS images of listing, as the page requests them.
+    Preprocessed images are skipped since their thumbnail size depends on the screen,
+    so are duplicates which share thumbnail of the first of them.
+    @param listing: files with meta in page order
+    @return: list of URLs relative to directory
+    """
+    urls = []
+    fingerprints = set()
+    for item in listing:
+        if len(urls) >= PRELOAD_THUMBNAILS:
+            break
+        ext = item['name'].rsplit('.')[-1].lower()
+        if MEDIA_EXTENSIONS.get(ext) != MediaTypes.IMAGE:
+            continue
+        if ext in PREPROCESSED_MEDIA_TYPES or item.get('fingerprint') in fingerprints:
+            continue
+        if item.get('fingerprint'):
+            fingerprints.add(item['fingerprint'])
+        urls.append(urllib.parse.quote(item['name'], safe="-_.!~*'()", errors='surrogatepass')
+                    + '?act=thumbnail&frame_ind=0')
+    return urls
+
+
+def get_gallery_js_config(static_export=False, listing=None, watch_position=None):
+    # '<' is escaped so names can't close the inline script
+    listing_json = json.dumps(listing).replace('<', '\\u003c')
+    return ('var THUMBNAIL_SIZES = {}; var PREFETCH_WINDOW = {}; var STATIC_EXPORT = {}; '
+            'var LISTING_PAGE_SIZE = {}; var INITIAL_LISTING = {}; var WATCH_POSITION = {};').format(
+        json.dumps(sorted(THUMBNAIL_SIZES)), PREFETCH_WINDOW, json.dumps(static_export),
+        LISTING_PAGE_SIZE, listing_json, json.dumps(watch_position))
+
+
+def get_gallery_html(display_path, dirs_list, static_export=False, listing=None, watch_position=None):
+    """
+    Gallery page of directory, served by list_directory or written by export.
+    @param display_path: HTML escaped path shown in title
+    @param dirs_list: paths of subdirectories
+    @param static_export: True if page reads pregenerated files instead of server API
+    @param listing: first page of files with meta embedded in page, None to fetch it
+    @param watch_position: position of directory watcher listing was read at
+    @return: HTML string
+    """
+    return GALLERY_HTML.format(encoding=sys.getfilesystemencoding(),
+                               display_path=display_path,
+                               gallery_css=GALLERY_CSS,
+                               gallery_js_script=(get_gallery_js_config(static_export, listing, watch_position)
+                                                  + GALLERY_JS_SCRIPT),
+                               help_icon=HELP_ICON,
+                               help_display=HELP_DISPLAY,
+                               dirs_list=get_dirs_list_html(dirs_list))
+
+
+def get_dirs_list_html(dirs_list):
+    r = list()
+    dirs_list.insert(0, "..")
+    for fullname in dirs_list:
+        name = os.path.basename(fullname)
+        display_name = link_name = name
+        # Append / for directories or @ for symbolic links
+        if os.path.isdir(fullname):
+            display_name = name + "/"
+            link_name = name + "/"
+        if os.path.islink(fullname):
+            display_name = name + "@"
+            # Note: a link to a directory displays with @ and links with /
+        r.append('<li class="dir"><a href="{href}">{text}</a></li>'.format(
+            href=urllib.parse.quote(link_name, errors='surrogatepass'),
+            text=html.escape(display_name, quote=False)))
+    return "\n".join(r)
+
+
+class MetaApi:
+    def __init__(self, root_path):
+        if os.path.isdir(root_path):
+            self.root_path = root_path
+        else:
+            self.root_path = os.curdir
+
+    @staticmethod
+    def call(method=None, **kwargs):
+        """
+        Calling api method by name.
+        @param method: method name (check help method)
+        @param kwargs: named arguments dictionary for method
+        @return: (result, HTTPStatus)
+        """
+        if type(method) is str \
+                and method != "call" \
+                and not method.startswith("_") \
+                and hasattr(MetaApi, method):
+            try:
+                return getattr(META_API, method)(**kwargs)
+            except TypeError:
+                doc, _ = MetaApi.help(method)
+                return doc, HTTPStatus.BAD_REQUEST
+        return MetaApi.help(**kwargs)
+
+    @staticmethod
+    def help(on=None):
+        """
+        Api help. Specify method for detailed help.
+        @param on: one of possible methods {methods}
+        """
+        def prepare_doc(doc=None):
+            if doc is None:
+                doc = "No documentation."
+            return doc.replace("\n        ", " ")
+        all_methods = [f for f in dir(MetaApi) if not f.startswith('_')]
+        if on not in all_methods:
+            return prepare_doc(MetaApi.help.__doc__.format(methods=all_methods)), HTTPStatus.OK
+        return prepare_doc(getattr(MetaApi, on).__doc__), HTTPStatus.OK
+
+    def list_directory(self, path=None, only_files=None, with_meta=None, offset='0', limit=None, after=None):
+        """
         Listing directory content.
         @param path: path of directory to list
         @param only_files: "yes" if only files wanted
-        @return: list of files and directories
+        @param with_meta: "yes" if image dimensions and placeholder colour wanted
+        @param offset: number of sorted names to skip [default: 0]
+        @param limit: maximal number of names returned [default: all]
+        @param after: list only names sorted after this one, unlike offset
+        pages stay contiguous when files are added or removed meanwhile
+        @return: list of files and directories names
+        or list of {name, width, height, placeholder, fingerprint} with_meta,
+        where equal fingerprints mean byte-identical files
         """
         if path is None:
             path = self.root_path
@@ -892,38 +2887,724 @@ class MetaApi:
             path = os.path.join(self.root_path, path)
         only_files = only_files == 'yes'
 
-        result = None
-        status = HTTPStatus.NOT_FOUND
-        if os.path.isdir(path):
+        result = None
+        status = HTTPStatus.NOT_FOUND
+        if os.path.isdir(path):
+            try:
+                offset = int(offset)
+                stop = None if limit is None else offset + int(limit)
+            except ValueError:
+                return "Offset and limit must be integers.", HTTPStatus.BAD_REQUEST
+            try:
+                if only_files:
+                    dir_list, _ = _scan_directory(path)
+                else:
+                    dir_list = sorted(os.listdir(path))
+                if after is not None:
+                    dir_list = dir_list[bisect.bisect_right(dir_list, after):]
+                if with_meta == 'yes':
+                    dir_list = _get_listing_page(path, dir_list[offset:], None if stop is None else stop - offset)
+                else:
+                    dir_list = dir_list[offset:stop]
+                result = dir_list
+                status = HTTPStatus.OK
+            except OSError:
+                pass
+        return result, status
+
+    def count_frames(self, image_path=None):
+        """
+        Count frames in multipage image file.
+        @param image_path:
+        @return: number of frames
+        """
+        if image_path is None:
+            return MetaApi.help('count_frames')
+        else:
+            image_path = self._sanitize_path(image_path)
+            image_path = os.path.join(self.root_path, image_path)
+
+        if _is_media_file(image_path, MediaTypes.IMAGE):
+            return _get_n_frames(image_path), HTTPStatus.OK
+        return "Not media file or not found.", HTTPStatus.BAD_REQUEST
+
+    def tile_info(self, image_path=None, frame_ind='0'):
+        """
+        Deep-zoom pyramid geometry of image frame for '?act=tile' requests.
+        @param image_path:
+        @param frame_ind: frame index [default: 0]
+        @return: {width, height, tile_size, max_level}
+        """
+        if image_path is None:
+            return MetaApi.help('tile_info')
+        else:
+            image_path = self._sanitize_path(image_path)
+            image_path = os.path.join(self.root_path, image_path)
+
+        ext = image_path.rsplit('.')[-1].lower()
+        if (IMREAD_ENABLED
+                and ext in PREPROCESSED_MEDIA_TYPES
+                and _is_media_file(image_path, MediaTypes.IMAGE)):
+            try:
+                pyramid = _get_pyramid(image_path, int(frame_ind))
+            except Exception:
+                # imread raises RuntimeError on broken files
+                pyramid = None
+            if pyramid is not None:
+                return pyramid.info(), HTTPStatus.OK
+        return "Not tiled image or not found.", HTTPStatus.BAD_REQUEST
+
+    def sprite_map(self, image_path=None, min_height='150', start='0', stop=None):
+        """
+        Offsets map of frame thumbnails packed into '?act=sprite' image.
+        @param image_path:
+        @param min_height: thumbnail height, snapped to size buckets [default: 150]
+        @param start: first frame index [default: 0]
+        @param stop: frame index to stop before [default: start + SPRITE_MAX_FRAMES]
+        @return: {frames_count, start, stop, min_height, columns, rows, cell_width, cell_height, frames}
+        """
+        if image_path is None:
+            return MetaApi.help('sprite_map')
+        else:
+            image_path = self._sanitize_path(image_path)
+            image_path = os.path.join(self.root_path, image_path)
+
+        ext = image_path.rsplit('.')[-1].lower()
+        if (IMREAD_ENABLED
+                and ext in PREPROCESSED_MEDIA_TYPES
+                and _is_media_file(image_path, MediaTypes.IMAGE)):
+            try:
+                start = int(start)
+                stop = start + SPRITE_MAX_FRAMES if stop is None else int(stop)
+                shapes, _ = _get_frame_thumbnails(image_path, [], max(THUMBNAIL_SIZES))
+                layout = _get_sprite_layout(shapes, _snap_thumbnail_size(int(min_height)), start, stop)
+            except Exception:
+                # imread raises RuntimeError on broken files
+                layout = None
+            if layout is not None:
+                return layout, HTTPStatus.OK
+        return "Not multi-frame image or not found.", HTTPStatus.BAD_REQUEST
+
+    @staticmethod
+    def cache_stats():
+        """
+        Statistics of in-memory cache of thumbnails and API responses (of serving process).
+        @return: {max_size, size, items, hits, misses, evictions, skipped}
+        """
+        return MEMORY_CACHE.stats(), HTTPStatus.OK
+
+    @staticmethod
+    def frame_cache_stats():
+        """
+        Statistics of decoded-frame cache of multi-frame images (of serving process).
+        @return: {max_size, size, items, hits, misses, evictions, skipped}
+        """
+        return FRAME_CACHE.stats(), HTTPStatus.OK
+
+    @staticmethod
+    def _sanitize_path(path):
+        return os.path.normpath(path).replace(os.pardir, '').lstrip(os.sep)
+
+
+class _DirectoryWatcher:
+    """
+    Watch single directory for added, removed and modified files and
+    publish events to subscribers queues. Uses inotify when available
+    (only changed names are checked) and polls directory otherwise.
+    Events are numbered and the latest ones are kept, so client which
+    got listing at some position gets only events after it. Watcher
+    without subscribers stops after WATCHER_IDLE_TIMEOUT.
+    """
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+
+    def __init__(self, path):
+        self.path = path
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # positions of another watcher (or worker process) never match this one's
+        self.epoch = os.urandom(8).hex()
+        self.seq = 0
+        self.history = deque(maxlen=WATCHER_HISTORY_SIZE)
+        self.idle_since = time.monotonic()
+        self.snapshot = self._scan()
+        self.inotify_fd = self._inotify_init()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def position(self):
+        """
+        Position of the latest event, listing read after it misses no later change.
+        """
+        with self.lock:
+            self.idle_since = time.monotonic()
+            return '{}-{}'.format(self.epoch, self.seq)
+
+    def subscribe(self, since=None):
+        """
+        Queue of (event, data, position) tuples of events after since.
+        If they are not kept any more, queue starts with 'reset' event.
+        @param since: position from position() or of event [default: from now on]
+        """
+        events = queue.Queue(maxsize=WATCHER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(events)
+            if since is None:
+                return events
+            epoch, _, seq = since.partition('-')
+            seq = int(seq) if epoch == self.epoch and seq.isdigit() else -1
+            oldest = self.history[0][0] if self.history else self.seq + 1
+            if not 0 <= seq <= self.seq or seq + 1 < oldest:
+                events.put_nowait(('reset', {}, '{}-{}'.format(self.epoch, self.seq)))
+                return events
+            for event_seq, event, data in self.history:
+                if event_seq > seq:
+                    events.put_nowait((event, data, '{}-{}'.format(self.epoch, event_seq)))
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self.subscribers.discard(events)
+            if not self.subscribers:
+                self.idle_since = time.monotonic()
+            return len(self.subscribers)
+
+    def stop(self):
+        self.stopped.set()
+
+    def _expire(self):
+        """
+        Stop watcher idle for WATCHER_IDLE_TIMEOUT. Position given to page is
+        valid meanwhile, so client opening the stream after it misses nothing.
+        """
+        with _WATCHERS_LOCK:
+            with self.lock:
+                if self.subscribers or time.monotonic() - self.idle_since < WATCHER_IDLE_TIMEOUT:
+                    return
+            self.stop()
+            if _WATCHERS.get(self.path) is self:
+                del _WATCHERS[self.path]
+
+    def _send(self, event, data):
+        with self.lock:
+            if event == 'reset':
+                # events were lost, so positions given out can't be resumed
+                self.epoch = os.urandom(8).hex()
+                self.seq = 0
+                self.history.clear()
+            else:
+                self.seq += 1
+                self.history.append((self.seq, event, data))
+            position = '{}-{}'.format(self.epoch, self.seq)
+            subscribers = list(self.subscribers)
+        for events in subscribers:
+            try:
+                events.put_nowait((event, data, position))
+            except queue.Full:
+                # slow client missed events, make it re-read the whole listing
+                with events.mutex:
+                    events.queue.clear()
+                events.put_nowait(('reset', {}, position))
+
+    def _publish(self, event, name):
+        data = {'name': name}
+        if event != 'remove':
+            try:
+                data.update(_get_file_meta(os.path.join(self.path, name)))
+            except OSError:
+                return
+        self._send(event, data)
+
+    def _scan(self):
+        snapshot = dict()
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            snapshot[entry.name] = _get_file_identity(entry.path)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return snapshot
+
+    def _check(self, name):
+        path = os.path.join(self.path, name)
+        state = None
+        try:
+            if os.path.isfile(path):
+                state = _get_file_identity(path)
+        except OSError:
+            pass
+        previous = self.snapshot.get(name)
+        if state is None:
+            if previous is not None:
+                del self.snapshot[name]
+                self._publish('remove', name)
+        elif previous is None:
+            self.snapshot[name] = state
+            self._publish('add', name)
+        elif previous != state:
+            self.snapshot[name] = state
+            self._publish('modify', name)
+
+    def _inotify_init(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            mask = (self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO
+                    | self.IN_DELETE | self.IN_DELETE_SELF | self.IN_MOVE_SELF)
+            if libc.inotify_add_watch(fd, os.fsencode(self.path), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (AttributeError, OSError, TypeError):
+            return None
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                self._expire()
+                if self.inotify_fd is None:
+                    self.stopped.wait(WATCHER_POLL_INTERVAL)
+                    for name in set(self.snapshot) | set(self._scan()):
+                        self._check(name)
+                    continue
+                ready, _, _ = select.select([self.inotify_fd], [], [], 1)
+                if not ready:
+                    continue
+                try:
+                    buffer = os.read(self.inotify_fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                names = list()
+                overflow = False
+                offset = 0
+                while offset + 16 <= len(buffer):
+                    _, mask, _, length = struct.unpack_from('iIII', buffer, offset)
+                    name = buffer[offset + 16:offset + 16 + length].rstrip(b'\x00')
+                    offset += 16 + length
+                    if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                        self.stopped.set()
+                    elif mask & self.IN_Q_OVERFLOW:
+                        overflow = True
+                    elif name:
+                        names.append(os.fsdecode(name))
+                if overflow:
+                    # kernel dropped events, so changed names are unknown
+                    self.snapshot = self._scan()
+                    self._send('reset', {})
+                    continue
+                for name in OrderedDict.fromkeys(names):
+                    self._check(name)
+        finally:
+            if self.inotify_fd is not None:
+                os.close(self.inotify_fd)
+
+
+_WATCHERS = dict()
+_WATCHERS_LOCK = threading.Lock()
+
+
+def _get_watcher(path):
+    """
+    Running watcher of directory, started if needed. Must be called with
+    _WATCHERS_LOCK held.
+    """
+    path = os.path.realpath(path)
+    watcher = _WATCHERS.get(path)
+    if watcher is None or watcher.stopped.is_set():
+        watcher = _WATCHERS[path] = _DirectoryWatcher(path)
+    return watcher
+
+
+def _get_watch_position(path):
+    """
+    Position of directory watcher to embed in page listing directory read
+    after this call, event stream opened from it misses no later change.
+    """
+    with _WATCHERS_LOCK:
+        return _get_watcher(path).position()
+
+
+def _subscribe_directory(path, since=None):
+    with _WATCHERS_LOCK:
+        watcher = _get_watcher(path)
+        return watcher, watcher.subscribe(since)
+
+
+def _unsubscribe_directory(watcher, events):
+    # watcher is stopped by itself once idle, pages rendered meanwhile may resume from it
+    watcher.unsubscribe(events)
+
+
+class _ChunkedWriter:
+    """
+    Write-only file object sending data as HTTP/1.1 chunked body
+    (or as is, for HTTP/1.0 clients), small writes are gathered into
+    chunks of ZIP_CHUNK_SIZE so memory use stays constant.
+    """
+    def __init__(self, wfile, chunked):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= ZIP_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            if self.chunked:
+                self.wfile.write(b'%x\r\n' % len(self.buffer))
+            self.wfile.write(self.buffer)
+            if self.chunked:
+                self.wfile.write(b'\r\n')
+            self.buffer = bytearray()
+        self.wfile.flush()
+
+    def close(self):
+        self.flush()
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+
+
+def _get_zip_members(base_path, names=None):
+    """
+    Files to archive with their archive names.
+    @param base_path: directory archive names are relative to
+    @param names: names of files or directories inside base_path [default: whole base_path]
+    @return: generator of (path, arcname)
+    """
+    base_path = os.path.realpath(base_path)
+    for name in [''] if names is None else names:
+        path = os.path.realpath(os.path.join(base_path, MetaApi._sanitize_path(name)))
+        if os.path.commonpath([base_path, path]) != base_path:
+            continue
+        if os.path.isfile(path):
+            yield path, os.path.relpath(path, base_path).replace(os.sep, '/')
+        elif os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(dir_path, file_name)
+                    if os.path.isfile(file_path):
+                        yield file_path, os.path.relpath(file_path, base_path).replace(os.sep, '/')
+
+
+def _write_zip(fileobj, members, compress=False):
+    """
+    Stream ZIP archive into unseekable file object. Entries use data
+    descriptors and ZIP64 extensions when needed, already compressed
+    media is always stored.
+    @param fileobj: writable file object
+    @param members: iterable of (path, arcname)
+    @param compress: deflate files which are not compressed already
+    """
+    with zipfile.ZipFile(fileobj, 'w') as zf:
+        for path, arcname in members:
             try:
-                dir_list = sorted(os.listdir(path))
-                if only_files:
-                    dir_list = [name for name in dir_list if os.path.isfile(os.path.join(path, name))]
-                result = dir_list
-                status = HTTPStatus.OK
+                src = open(path, 'rb')
             except OSError:
-                pass
-        return result, status
+                continue
+            with src:
+                stat = os.fstat(src.fileno())
+                date_time = max(time.localtime(stat.st_mtime)[:6], (1980, 1, 1, 0, 0, 0))
+                zinfo = zipfile.ZipInfo(arcname, date_time)
+                zinfo.file_size = stat.st_size
+                zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16
+                ext = arcname.rsplit('.')[-1].lower()
+                if compress and ext not in ZIP_STORED_EXTENSIONS:
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                with zf.open(zinfo, 'w') as dst:
+                    shutil.copyfileobj(src, dst, ZIP_CHUNK_SIZE)
 
-    def count_frames(self, image_path=None):
+
+class _TokenBucket:
+    """
+    Token bucket rate limiter shared by threads, and by worker processes
+    when its state is in shared memory. Consumers reserve tokens right away
+    and sleep off the debt outside of lock, so waiting streams are served
+    in turn and bytes charged without waiting push them back.
+    """
+    def __init__(self, rate, state=None, index=0, lock=None):
         """
-        Count frames in multipage image file.
-        @param image_path:
-        @return: number of frames
+        @param rate: tokens (bytes) per second, burst capacity is the same
+        @param state: array of (tokens, timestamp) pairs holding state of bucket [default: own list]
+        @param index: index of pair of this bucket in state
+        @param lock: lock guarding state [default: own lock]
         """
-        if image_path is None:
-            return MetaApi.help('count_frames')
-        else:
-            image_path = self._sanitize_path(image_path)
-            image_path = os.path.join(self.root_path, image_path)
+        self.rate = rate
+        self.capacity = rate
+        self.state = [0.0, 0.0] if state is None else state
+        self.index = 2 * index
+        self.lock = threading.Lock() if lock is None else lock
+        self.reset()
 
-        if _is_media_file(image_path, MediaTypes.IMAGE):
-            return _get_n_frames(image_path), HTTPStatus.OK
-        return "Not media file or not found.", HTTPStatus.BAD_REQUEST
+    def reset(self):
+        self.state[self.index] = self.capacity
+        self.state[self.index + 1] = time.monotonic()
+
+    def consume(self, amount, wait=True):
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, self.state[self.index] + (now - self.state[self.index + 1]) * self.rate)
+            tokens -= amount
+            self.state[self.index] = tokens
+            self.state[self.index + 1] = now
+            delay = -tokens / self.rate if wait and tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def is_idle(self):
+        """
+        Check if bucket is full, must be called with lock held.
+        """
+        elapsed = time.monotonic() - self.state[self.index + 1]
+        return self.state[self.index] + elapsed * self.rate >= self.capacity
+
+
+def _make_bucket_state(size, shared):
+    """
+    Array of token bucket states and its lock, in shared memory when
+    buckets are shared by worker processes forked after this call.
+    """
+    if shared:
+        return multiprocessing.RawArray('d', 2 * size), multiprocessing.Lock()
+    return [0.0] * (2 * size), threading.Lock()
+
+
+class _ClientBuckets:
+    """
+    Fixed table of per-client token buckets, which can live in shared
+    memory, so limit of client holds whichever worker serves it. Client
+    owns slot found by hash of its address, slots of clients which
+    didn't use up their burst are reused.
+    """
+    def __init__(self, rate, size, shared):
+        state, self.lock = _make_bucket_state(size, shared)
+        self.keys = multiprocessing.RawArray('Q', size) if shared else [0] * size
+        self.buckets = [_TokenBucket(rate, state, i, self.lock) for i in range(size)]
+
+    def get(self, client_address):
+        key = int.from_bytes(hashlib.blake2b(client_address.encode('utf-8', 'surrogatepass'),
+                                             digest_size=8).digest(), 'little') or 1
+        size = len(self.buckets)
+        slots = [(key + i) % size for i in range(min(CLIENT_BUCKETS_PROBES, size))]
+        with self.lock:
+            for slot in slots:
+                if self.keys[slot] == key:
+                    return self.buckets[slot]
+            for slot in slots:
+                if self.keys[slot] == 0 or self.buckets[slot].is_idle():
+                    self.keys[slot] = key
+                    self.buckets[slot].reset()
+                    return self.buckets[slot]
+        # table is busy, client shares bucket of another one
+        return self.buckets[slots[0]]
+
+
+_GLOBAL_BUCKET = None
+_CLIENT_BUCKETS = None
+
+
+def _get_buckets(client_address):
+    """
+    Token buckets limiting response of client: its own and global one.
+    """
+    buckets = list()
+    if _CLIENT_BUCKETS is not None:
+        buckets.append(_CLIENT_BUCKETS.get(client_address))
+    if _GLOBAL_BUCKET is not None:
+        buckets.append(_GLOBAL_BUCKET)
+    return buckets
+
+
+class _CountingWriter:
+    """
+    Write-only file object counting bytes of response for access log.
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.written = 0
+
+    @property
+    def closed(self):
+        return self.wfile.closed
+
+    def write(self, data):
+        self.wfile.write(data)
+        self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        self.wfile.close()
 
-    @staticmethod
-    def _sanitize_path(path):
-        return os.path.normpath(path).replace(os.pardir, '').lstrip(os.sep)
+
+class _ShapedWriter:
+    """
+    Write-only file object limiting bandwidth with token buckets.
+    First BANDWIDTH_FREE_BYTES of every response are sent at once and only
+    charged, so thumbnails, API responses and pages are not delayed by bulk
+    media transfers, which wait for tokens chunk by chunk.
+    """
+    def __init__(self, wfile, buckets):
+        self.wfile = wfile
+        self.buckets = buckets
+        self.written = 0
+
+    @property
+    def closed(self):
+        return self.wfile.closed
+
+    def write(self, data):
+        data = memoryview(data)
+        for offset in range(0, len(data), BANDWIDTH_CHUNK_SIZE):
+            chunk = data[offset:offset + BANDWIDTH_CHUNK_SIZE]
+            wait = self.written >= BANDWIDTH_FREE_BYTES
+            for bucket in self.buckets:
+                bucket.consume(len(chunk), wait)
+            self.wfile.write(chunk)
+            self.written += len(chunk)
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        self.wfile.close()
+
+
+_ACCESS_LOG_QUEUE = queue.Queue(ACCESS_LOG_QUEUE_SIZE)
+_ACCESS_LOG_WORKER = None
+_ACCESS_LOG_DROPPED = 0
+_ACCESS_LOG_LOCK = threading.Lock()
+_CACHE_STATUS = threading.local()
+
+
+def _set_cache_status(status):
+    """
+    Record which cache served response of current request, for access log.
+    @param status: 'memory', 'disk', 'miss' or 'not-modified'
+    """
+    _CACHE_STATUS.value = status
+
+
+def _format_log_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + '.{:03d}Z'.format(
+        int(timestamp % 1 * 1000))
+
+
+def _is_access_logged(level):
+    """
+    Check level of entry against ACCESS_LOG_LEVEL, successful requests are sampled.
+    """
+    if not ACCESS_LOG or ACCESS_LOG_LEVELS.index(level) < ACCESS_LOG_LEVELS.index(ACCESS_LOG_LEVEL):
+        return False
+    return level != 'info' or random.random() < ACCESS_LOG_SAMPLE
+
+
+def _log_access(entry):
+    """
+    Queue access log entry for background writer. When writer falls behind
+    entry is dropped rather than delaying response, drops are counted.
+    """
+    global _ACCESS_LOG_WORKER, _ACCESS_LOG_DROPPED
+    # thread is not alive in worker process forked after it was started
+    if _ACCESS_LOG_WORKER is None or not _ACCESS_LOG_WORKER.is_alive():
+        with _ACCESS_LOG_LOCK:
+            if _ACCESS_LOG_WORKER is None or not _ACCESS_LOG_WORKER.is_alive():
+                _ACCESS_LOG_WORKER = threading.Thread(target=_access_log_worker, daemon=True)
+                _ACCESS_LOG_WORKER.start()
+    try:
+        _ACCESS_LOG_QUEUE.put_nowait(entry)
+    except queue.Full:
+        with _ACCESS_LOG_LOCK:
+            _ACCESS_LOG_DROPPED += 1
+
+
+def _open_access_log():
+    if ACCESS_LOG == '-':
+        return sys.stderr
+    return open(ACCESS_LOG, 'a', encoding='utf-8')
+
+
+def _rotate_access_log(stream):
+    """
+    Shift full log file to ACCESS_LOG.1, older backups to next numbers,
+    the last one is removed. If another worker process has rotated the
+    file already it is only reopened.
+    @return: stream of new log file
+    """
+    try:
+        if os.path.samestat(os.fstat(stream.fileno()), os.stat(ACCESS_LOG)):
+            for i in range(ACCESS_LOG_BACKUPS - 1, 0, -1):
+                backup_path = '{path}.{i}'.format(path=ACCESS_LOG, i=i)
+                if os.path.exists(backup_path):
+                    os.replace(backup_path, '{path}.{i}'.format(path=ACCESS_LOG, i=i + 1))
+            if ACCESS_LOG_BACKUPS > 0:
+                os.replace(ACCESS_LOG, ACCESS_LOG + '.1')
+            else:
+                os.remove(ACCESS_LOG)
+    except OSError:
+        pass
+    stream.close()
+    return _open_access_log()
+
+
+def _access_log_worker():
+    global _ACCESS_LOG_DROPPED
+    stream = None
+    while True:
+        entries = [_ACCESS_LOG_QUEUE.get()]
+        try:
+            while len(entries) < ACCESS_LOG_BATCH_SIZE:
+                entries.append(_ACCESS_LOG_QUEUE.get_nowait())
+        except queue.Empty:
+            pass
+        with _ACCESS_LOG_LOCK:
+            dropped, _ACCESS_LOG_DROPPED = _ACCESS_LOG_DROPPED, 0
+        lines = [json.dumps(entry) + '\n' for entry in entries]
+        if dropped:
+            lines.append(json.dumps({'time': _format_log_time(time.time()), 'level': 'warning',
+                                     'message': '{n} entries dropped, log queue was full'.format(n=dropped)}) + '\n')
+        try:
+            if stream is None:
+                stream = _open_access_log()
+            stream.write(''.join(lines))
+            stream.flush()
+            if stream is not sys.stderr and 0 < ACCESS_LOG_MAX_SIZE <= stream.tell():
+                stream = _rotate_access_log(stream)
+        except (OSError, ValueError):
+            # log file is reopened for the next entries
+            stream = None
+        for _ in entries:
+            _ACCESS_LOG_QUEUE.task_done()
+
+
+def _flush_access_log(timeout):
+    """
+    Wait until queued access log entries are written, before process exits.
+    """
+    with _ACCESS_LOG_QUEUE.all_tasks_done:
+        _ACCESS_LOG_QUEUE.all_tasks_done.wait_for(lambda: not _ACCESS_LOG_QUEUE.unfinished_tasks, timeout)
 
 
 class Router:
@@ -932,17 +3613,159 @@ class Router:
 
 
 class RequestHandler(SimpleHTTPRequestHandler):
+    extra_headers = ()
+    request_started = None
+    headers_sent = None
+    log_status = None
+    log_notes = ()
+    log_aborted = False
+
+    def setup(self):
+        super().setup()
+        buckets = _get_buckets(self.client_address[0])
+        if buckets:
+            self.wfile = _ShapedWriter(self.wfile, buckets)
+        else:
+            self.wfile = _CountingWriter(self.wfile)
+
+    def handle_one_request(self):
+        # every response on keep-alive connection starts unthrottled and is counted from zero
+        self.wfile.written = 0
+        self.request_started = self.headers_sent = None
+        # malformed request line leaves them unset, or set by previous request
+        self.command = self.path = None
+        self.log_status = None
+        self.log_notes = []
+        self.log_aborted = False
+        _set_cache_status(None)
+        try:
+            super().handle_one_request()
+        finally:
+            # aborted responses are logged too, with bytes sent until then
+            self.log_access()
+
+    def parse_request(self):
+        # timing starts when request line is read, not while keep-alive connection idles
+        self.request_started = time.perf_counter()
+        return super().parse_request()
+
+    def end_headers(self):
+        for keyword, value in self.extra_headers:
+            self.send_header(keyword, value)
+        self.extra_headers = []
+        super().end_headers()
+        if self.headers_sent is None:
+            self.headers_sent = time.perf_counter()
+
+    def log_request(self, code='-', size='-'):
+        # entry is logged by log_access once response is written
+        if isinstance(code, int):
+            self.log_status = int(code)
+
+    def log_message(self, format, *args):
+        # request may log several messages, e.g. error and its details
+        self.log_notes.append(format % args)
+
+    def log_access(self):
+        """
+        Queue structured access log entry of request with its timings,
+        response size and cache status, or of error which stopped request
+        from being read. Responses aborted after headers are logged as errors.
+        """
+        if self.request_started is None and not self.log_notes:
+            return
+        status = self.log_status
+        if status is None or status >= 500 or self.log_aborted:
+            level = 'error'
+        elif status >= 400:
+            level = 'warning'
+        else:
+            level = 'info'
+        if not _is_access_logged(level):
+            return
+        now = time.perf_counter()
+        entry = {'time': _format_log_time(time.time()),
+                 'level': level,
+                 'client': self.client_address[0],
+                 'method': None,
+                 'path': None,
+                 'status': status,
+                 'bytes': self.wfile.written,
+                 'duration_ms': None,
+                 'ttfb_ms': None,
+                 'cache': getattr(_CACHE_STATUS, 'value', None)}
+        if self.request_started is not None:
+            entry['method'] = self.command
+            entry['path'] = self.path
+            entry['duration_ms'] = round((now - self.request_started) * 1000, 3)
+            if self.headers_sent is not None:
+                entry['ttfb_ms'] = round((self.headers_sent - self.request_started) * 1000, 3)
+        if self.log_notes:
+            entry['message'] = '; '.join(self.log_notes)
+        _log_access(entry)
+
+    def check_not_modified(self, path, *params):
+        """
+        Add validators of file (or of image generated from it with params)
+        to response headers and answer conditional request.
+        @return: True if client's copy is valid and 304 was sent
+        """
+        try:
+            etag = _get_etag(path, *params)
+            self.extra_headers = list(self.extra_headers) + [("ETag", etag)]
+            if params:
+                # files themselves get Last-Modified from SimpleHTTPRequestHandler
+                self.extra_headers.append(("Last-Modified", self.date_time_string(os.stat(path).st_mtime)))
+        except OSError:
+            return False
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if '*' not in tags and etag not in tags and 'W/' + etag not in tags:
+            return False
+        _set_cache_status('not-modified')
+        self.send_response(HTTPStatus.NOT_MODIFIED)
+        self.end_headers()
+        return True
+
+    def negotiate_image_format(self):
+        """
+        Format of generated image for this client, the response varies by Accept header.
+        """
+        self.extra_headers = list(self.extra_headers) + [("Vary", "Accept")]
+        return _negotiate_image_format(self.headers.get("Accept", ""))
+
     def rest_api(self, method, api_args=None):
         enc = 'utf-8'
         result = None
         status = HTTPStatus.NOT_FOUND
-        if META_API is not None:
-            result, status = META_API.call(method, **api_args)
-        result = io.BytesIO(json.dumps(result).encode('utf-8'))
+        cache_key = None
+        if META_API is not None and method in CACHED_API_METHODS and api_args.get('image_path'):
+            # results depend only on the image content, so they are shared by duplicates
+            image_path = os.path.join(META_API.root_path, MetaApi._sanitize_path(api_args['image_path']))
+            try:
+                params = sorted((key, value) for key, value in api_args.items() if key != 'image_path')
+                cache_key = json.dumps([method, params, _get_content_key(image_path)])
+            except OSError:
+                pass
+        data = None if cache_key is None else MEMORY_CACHE.get(cache_key)
+        if data is not None:
+            _set_cache_status('memory')
+            status = HTTPStatus.OK
+        else:
+            if cache_key is not None:
+                _set_cache_status('miss')
+            if META_API is not None:
+                result, status = META_API.call(method, **api_args)
+            data = json.dumps(result).encode(enc)
+            if cache_key is not None and status == HTTPStatus.OK:
+                MEMORY_CACHE.put(cache_key, data)
         self.send_response(status)
         self.send_header("Content-Type", "application/json; charset={charset}".format(charset=enc))
+        self.send_header("Content-Length", str(len(data)))
         self.end_headers()
-        return result
+        return io.BytesIO(data)
 
     def list_directory(self, path):
         """Helper to produce a directory listing (absent index.html).
@@ -953,14 +3776,16 @@ class RequestHandler(SimpleHTTPRequestHandler):
 
         """
         try:
-            directory_items = glob(os.path.join(path, '*'))
+            # taken before directory is read, so events after it cover every later change
+            watch_position = _get_watch_position(path)
+            files_list, dirs_list = _scan_directory(path)
         except OSError:
             self.send_error(
                 HTTPStatus.NOT_FOUND,
                 "No permission to list directory")
             return None
-        directory_items.sort(key=lambda a: a.lower())
-        dirs_list = [el for el in directory_items if os.path.isdir(el)]
+        # first page goes into the page itself, saving the round trip to listing API
+        listing = _get_listing_page(path, files_list, LISTING_PAGE_SIZE)
 
         try:
             display_path = urllib.parse.unquote(self.path,
@@ -970,13 +3795,7 @@ class RequestHandler(SimpleHTTPRequestHandler):
         display_path = html.escape(display_path, quote=False)
         enc = sys.getfilesystemencoding()
 
-        html_str = GALLERY_HTML.format(encoding=enc,
-                                       display_path=display_path,
-                                       gallery_css=GALLERY_CSS,
-                                       gallery_js_script=GALLERY_JS_SCRIPT,
-                                       help_icon=HELP_ICON,
-                                       help_display=HELP_DISPLAY,
-                                       dirs_list=get_dirs_list_html(dirs_list))
+        html_str = get_gallery_html(display_path, dirs_list, listing=listing, watch_position=watch_position)
         html_encoded = html_str.encode(enc, 'surrogateescape')
 
         f = io.BytesIO()
@@ -985,10 +3804,108 @@ class RequestHandler(SimpleHTTPRequestHandler):
         self.send_response(HTTPStatus.OK)
         self.send_header("Content-Type", "text/html; charset={charset}".format(charset=enc))
         self.send_header("Content-Length", str(len(html_encoded)))
+        for url in _get_preload_urls(listing):
+            self.send_header("Link", "<{url}>; rel=preload; as=image".format(url=url))
         self.end_headers()
         return f
 
+    def stream_zip(self, path, names=None, compress=False):
+        """
+        Stream ZIP archive of directory or of selected files in it,
+        generated on the fly without staging archive on disk.
+        """
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.protocol_version = 'HTTP/1.1'
+        archive_name = os.path.basename(os.path.normpath(path)) or 'archive'
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Disposition", "attachment; filename*=UTF-8''{}.zip".format(
+            urllib.parse.quote(archive_name, errors='surrogatepass')))
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        writer = _ChunkedWriter(self.wfile, chunked)
+        try:
+            _write_zip(writer, _get_zip_members(path, names), compress)
+            writer.close()
+        except OSError:
+            # client went away
+            pass
+        except Exception as e:
+            # archive is half sent, so no error response can follow it: connection
+            # is closed without final chunk and client sees download failed
+            self.log_aborted = True
+            self.log_error('ZIP archive aborted: %s', e)
+
+    def do_POST(self):
+        """Serve a POST request: ZIP archive of posted files list."""
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        path = self.translate_path(self.path)
+        if params.get('act', [None])[0] != 'zip' or not os.path.isdir(path):
+            self.send_error(HTTPStatus.NOT_IMPLEMENTED, "Only '?act=zip' is supported")
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if not 0 < length <= ZIP_MAX_REQUEST_SIZE:
+            self.send_error(HTTPStatus.BAD_REQUEST, "Files list is missing or too big")
+            return
+        body = self.rfile.read(length).decode('utf-8', errors='surrogateescape')
+        if self.headers.get_content_type() == 'application/json':
+            try:
+                names = json.loads(body)
+            except ValueError:
+                names = None
+        else:
+            form = parse_qs(body)
+            names = form.get('files')
+            params.update(form)
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            self.send_error(HTTPStatus.BAD_REQUEST, "Expected list of file names")
+            return
+        self.stream_zip(path, names, compress=params.get('compress', [None])[0] == 'yes')
+
+    def stream_events(self, path, since=None):
+        """
+        Stream directory changes as Server-Sent Events ('add', 'remove',
+        'modify' with file metadata as data) until client disconnects.
+        Events after position since, or after Last-Event-ID of reconnecting
+        client, are sent first, so client keeps listing it has. 'reset'
+        tells client to read the whole listing again when they are lost.
+        """
+        since = self.headers.get("Last-Event-ID") or since
+        watcher, events = _subscribe_directory(path, since)
+        try:
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(b'retry: 3000\n\n')
+            self.wfile.flush()
+            last_message_time = time.monotonic()
+            while not self.server.stopping.is_set():
+                try:
+                    event, data, position = events.get(timeout=1)
+                    message = 'event: {}\nid: {}\ndata: {}\n\n'.format(event, position, json.dumps(data))
+                except queue.Empty:
+                    if time.monotonic() - last_message_time < EVENTS_KEEPALIVE_INTERVAL:
+                        continue
+                    message = ': keep-alive\n\n'
+                self.wfile.write(message.encode('utf-8'))
+                self.wfile.flush()
+                last_message_time = time.monotonic()
+        except OSError:
+            pass
+        finally:
+            _unsubscribe_directory(watcher, events)
+
     def send_head(self):
+        self.extra_headers = []
         url = urlparse(self.path)
         params = parse_qs(url.query)
 
@@ -1003,25 +3920,112 @@ class RequestHandler(SimpleHTTPRequestHandler):
             return param
 
         if 'act' in params and len(params['act']) > 0 and params['act'][0] == 'thumbnail':
-            min_height = _get_param_value('min_height', 600, int)
+            min_height = _snap_thumbnail_size(_get_param_value('min_height', 600, int))
             frame_ind = _get_param_value('frame_ind', -1, int)
 
             path = self.translate_path(self.path)
+            generated = IMREAD_ENABLED and path.rsplit('.')[-1].lower() in PREPROCESSED_MEDIA_TYPES
+            if generated:
+                target_format = self.negotiate_image_format()
+                validator_params = ('thumbnail', min_height, frame_ind,
+                                    target_format, THUMBNAIL_QUALITY, THUMBNAIL_PROGRESSIVE)
+            else:
+                # other images are served as they are whatever client accepts, so file validator fits
+                target_format = 'jpg'
+                validator_params = ()
+            if self.check_not_modified(path, *validator_params):
+                return None
+
+            f = _get_preview(path, min_height, frame_ind, target_format)
+            if f is not None:
+                self.send_response(HTTPStatus.OK)
+                if generated:
+                    self.send_header("Content-Type", IMAGE_FORMAT_TYPES[target_format])
+                else:
+                    # other images are previewed as they are
+                    self.send_header("Content-Type", self.guess_type(path))
+                self.end_headers()
+                return f
+            else:
+                self.send_response(HTTPStatus.NOT_FOUND)
+                self.end_headers()
+                return f
+        elif 'act' in params and len(params['act']) > 0 and params['act'][0] == 'tile':
+            try:
+                level = _get_param_value('level', 0, int)
+                x = _get_param_value('x', 0, int)
+                y = _get_param_value('y', 0, int)
+                frame_ind = _get_param_value('frame_ind', 0, int)
+            except ValueError:
+                self.send_error(HTTPStatus.BAD_REQUEST, "Tile level, x, y and frame_ind must be integers")
+                return None
+
+            path = self.translate_path(self.path)
+            target_format = self.negotiate_image_format()
+            if self.check_not_modified(path, 'tile', level, x, y, frame_ind,
+                                       target_format, THUMBNAIL_QUALITY, THUMBNAIL_PROGRESSIVE):
+                return None
+
+            f = _get_tile(path, level, x, y, frame_ind, target_format)
+            if f is not None:
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-Type", IMAGE_FORMAT_TYPES[target_format])
+                self.end_headers()
+                return f
+            else:
+                self.send_response(HTTPStatus.NOT_FOUND)
+                self.end_headers()
+                return f
+        elif 'act' in params and len(params['act']) > 0 and params['act'][0] == 'sprite':
+            try:
+                min_height = _snap_thumbnail_size(_get_param_value('min_height', 150, int))
+                start = _get_param_value('start', 0, int)
+                stop = _get_param_value('stop', start + SPRITE_MAX_FRAMES, int)
+            except ValueError:
+                self.send_error(HTTPStatus.BAD_REQUEST, "Sprite min_height, start and stop must be integers")
+                return None
+
+            path = self.translate_path(self.path)
+            target_format = self.negotiate_image_format()
+            if self.check_not_modified(path, 'sprite', min_height, start, stop,
+                                       target_format, THUMBNAIL_QUALITY, THUMBNAIL_PROGRESSIVE):
+                return None
 
-            f = _get_preview(path, min_height, frame_ind)
+            f = _get_sprite(path, min_height, start, stop, target_format)
             if f is not None:
                 self.send_response(HTTPStatus.OK)
-                self.send_header("Content-Type", "image")
+                self.send_header("Content-Type", IMAGE_FORMAT_TYPES[target_format])
                 self.end_headers()
                 return f
             else:
                 self.send_response(HTTPStatus.NOT_FOUND)
                 self.end_headers()
                 return f
+        elif ('act' in params and len(params['act']) > 0 and params['act'][0] == 'zip'
+                and self.command == 'GET'):
+            path = self.translate_path(self.path)
+            if os.path.isdir(path):
+                self.stream_zip(path, compress=_get_param_value('compress', None) == 'yes')
+                return None
+            self.send_error(HTTPStatus.NOT_FOUND, "Directory not found")
+            return None
+        elif ('act' in params and len(params['act']) > 0 and params['act'][0] == 'events'
+                and self.command == 'GET'):
+            path = self.translate_path(self.path)
+            if os.path.isdir(path):
+                self.stream_events(path, _get_param_value('since', None))
+                return None
+            self.send_error(HTTPStatus.NOT_FOUND, "Directory not found")
+            return None
         elif self.path == "/favicon.ico":
             f = io.BytesIO()
             f.write(ICON)
             f.seek(0)
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "image/x-icon")
+            self.send_header("Content-Length", str(len(ICON)))
+            self.send_header("Cache-Control", "max-age=86400")
+            self.end_headers()
             return f
         elif url.path.startswith('/api/'):
             url_parts = url.path.split('/')
@@ -1029,10 +4033,328 @@ class RequestHandler(SimpleHTTPRequestHandler):
                 method = url_parts[2]
                 api_args = {n: _get_param_value(n, '') for n in params}
                 return self.rest_api(method=method, api_args=api_args)
+        path = self.translate_path(self.path)
+        if os.path.isfile(path) and self.check_not_modified(path):
+            return None
         return super().send_head()
 
 
-def run_server(port, dir_path):
+class GalleryServer(socketserver.ThreadingTCPServer):
+    """
+    Threading server which keeps count of requests in progress,
+    so it can stop gracefully.
+    """
+    # Configure allow_reuse_address to make re-runs of the script less painful -
+    # if this is not True then waiting for the address to be freed after the
+    # last run can block a subsequent run
+    allow_reuse_address = True
+    # Event streams never end by themselves, they must not keep process alive
+    daemon_threads = True
+
+    def __init__(self, server_address, request_handler):
+        super().__init__(server_address, request_handler)
+        self.stopping = threading.Event()
+        self.active_requests = 0
+        self.active_requests_changed = threading.Condition()
+
+    def get_request(self):
+        conn, client_address = super().get_request()
+        # listening socket of workers is non-blocking, and on BSD and macOS
+        # accepted sockets inherit it, but handlers expect blocking ones
+        conn.setblocking(True)
+        return conn, client_address
+
+    def process_request_thread(self, request, client_address):
+        with self.active_requests_changed:
+            self.active_requests += 1
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.active_requests_changed:
+                self.active_requests -= 1
+                self.active_requests_changed.notify_all()
+
+    def stop(self):
+        """
+        Stop accepting connections and end event streams.
+        Blocks until serve_forever() returns, so call it from other thread.
+        """
+        self.stopping.set()
+        self.shutdown()
+
+    def wait_requests(self, timeout):
+        """
+        Wait up to timeout seconds for requests in progress to finish.
+        """
+        with self.active_requests_changed:
+            self.active_requests_changed.wait_for(lambda: self.active_requests == 0, timeout)
+
+
+def _run_worker(server):
+    def stop(signum, frame):
+        threading.Thread(target=server.stop, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # all workers are woken up by every connection, only one accepts it
+    server.socket.setblocking(False)
+    try:
+        server.serve_forever()
+        server.wait_requests(WORKER_SHUTDOWN_TIMEOUT)
+        _flush_access_log(ACCESS_LOG_FLUSH_TIMEOUT)
+    finally:
+        os._exit(0)
+
+
+def _serve_workers(server, workers):
+    """
+    Pre-fork worker processes which inherit listening socket of server
+    and wait for them. Workers which die unexpectedly are restarted.
+    SIGINT or SIGTERM stops workers gracefully.
+    Workers share only on-disk thumbnail cache, entries of which are
+    written atomically, so concurrent generation of the same entry is safe.
+    """
+    pids = set()
+    stopping = False
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(server)
+        pids.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(workers):
+        start_worker()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while pids:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        pids.discard(pid)
+        if not stopping:
+            print('Worker {pid} exited unexpectedly, restarting'.format(pid=pid))
+            start_worker()
+    server.server_close()
+    print('Workers stopped')
+
+
+def _write_exported_image(ndimage, path):
+    f = _ndimage_to_file(ndimage, 'jpg', cache_path=path)
+    if f is None:
+        raise OSError('{path} was not written'.format(path=path))
+    f.close()
+
+
+def _write_exported_json(data, path):
+    fd, tmp_path = tempfile.mkstemp(suffix='.json', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _export_file(path, export_dir, thumbnail_sizes):
+    """
+    Generate metadata, thumbnails and frame sprites of single file for
+    static export. Runs in worker process of export pool.
+    @param path: source file path
+    @param export_dir: directory for generated files of this source file
+    @param thumbnail_sizes: thumbnail heights to generate
+    @return: (meta, True if all files were generated)
+    """
+    meta, decode_placeholder = _read_file_meta(path)
+    # every exported file is hashed whole, so equal fingerprints need no verification
+    try:
+        meta['fingerprint'] = '{:x}-{}'.format(os.path.getsize(path), _hash_file(path, sampled=False)[0])
+    except OSError as e:
+        print('{path}: {error}'.format(path=path, error=e))
+        meta['fingerprint'] = None
+        return meta, False
+    ext = path.rsplit('.')[-1].lower()
+    if not IMREAD_ENABLED or MEDIA_EXTENSIONS.get(ext) != MediaTypes.IMAGE:
+        return meta, True
+    try:
+        if ext in PREPROCESSED_MEDIA_TYPES:
+            # all thumbnails and sprites are taken from this single read of the file
+            frames = _read_frames(path)
+            frames_count = len(frames)
+            shapes = [frame.shape[:2] for frame in frames]
+            os.makedirs(export_dir, exist_ok=True)
+            for size in thumbnail_sizes:
+                _write_exported_image(_subsample_frame(frames[0], size),
+                                      os.path.join(export_dir, 'thumbnail-0-{}.jpg'.format(size)))
+                start = 1
+                while start < frames_count:
+                    # sprites split where pixel limit is reached, page follows their stop
+                    layout = _get_sprite_layout(shapes, size, start, start + SPRITE_MAX_FRAMES)
+                    name = 'sprite-{}-{}'.format(size, start)
+                    _write_exported_json(layout, os.path.join(export_dir, name + '.json'))
+                    thumbnails = [_subsample_frame(frames[cell['frame_ind']], size) for cell in layout['frames']]
+                    _write_exported_image(_make_sprite(layout, thumbnails), os.path.join(export_dir, name + '.jpg'))
+                    start = layout['stop']
+            if meta['placeholder'] is None:
+                meta['placeholder'] = _get_placeholder_color(frames[0])
+        elif decode_placeholder:
+            meta['placeholder'] = _get_placeholder_color(_read_placeholder_image(path))
+    except Exception as e:
+        print('{path}: {error}'.format(path=path, error=e))
+        return meta, False
+    return meta, True
+
+
+def _export_original(src_path, dst_path):
+    # hard link costs no space and follows in-place edits, copy is fallback
+    # for output on another file system
+    try:
+        if os.path.lexists(dst_path):
+            if (os.path.samefile(src_path, dst_path)
+                    or _get_file_identity(src_path) == _get_file_identity(dst_path)):
+                return
+            os.remove(dst_path)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        try:
+            os.link(src_path, dst_path)
+        except OSError:
+            shutil.copy2(src_path, dst_path)
+    except OSError as e:
+        print(e)
+
+
+def export_gallery(dir_path, output_path, thumbnail_sizes=None, jobs=None):
+    """
+    Export gallery of directory tree as static site, which can be hosted
+    by any static file server without servGallery. Every directory gets
+    index.html page, listing JSON, thumbnails and frame sprites of
+    multipage images. Originals are hard linked (or copied).
+    Export is incremental: only files changed since previous export
+    into the same output directory, or failed in it, are processed again.
+
+    @param {String} dir_path - The directory path (absolute, or relative to CWD)
+    @param {String} output_path - The output directory path
+    @param {List} thumbnail_sizes - Thumbnail heights to generate
+    @param {Integer} jobs - Number of worker processes [default: number of CPUs]
+
+    @return {None}
+    """
+    global THUMBNAIL_SIZES
+    if thumbnail_sizes and min(thumbnail_sizes) <= 0:
+        raise ValueError('Thumbnail sizes must be positive.')
+    if thumbnail_sizes:
+        THUMBNAIL_SIZES = sorted(thumbnail_sizes)
+    dir_path = os.path.abspath(dir_path)
+    output_path = os.path.abspath(output_path)
+    if dir_path == output_path:
+        print('Output directory must differ from exported directory.')
+        return
+    if not IMREAD_ENABLED:
+        print(IMREAD_NOT_ENABLED_MSG)
+
+    # settings affecting generated files, any change invalidates all of them
+    params = {'thumbnail_sizes': THUMBNAIL_SIZES, 'sprite_max_frames': SPRITE_MAX_FRAMES,
+              'sprite_max_pixels': SPRITE_MAX_PIXELS}
+    manifest_path = os.path.join(output_path, EXPORT_DIR_NAME, 'manifest.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {'params': params, 'dirs': [], 'files': {}}
+    reprocess = manifest['params'] != params
+
+    dirs = dict()
+    for root, subdirs, names in os.walk(dir_path):
+        subdirs[:] = sorted(name for name in subdirs
+                            if name != EXPORT_DIR_NAME
+                            and os.path.join(root, name) != output_path
+                            and not os.path.islink(os.path.join(root, name)))
+        names = sorted(name for name in names if os.path.isfile(os.path.join(root, name)))
+        dirs[os.path.relpath(root, dir_path)] = (subdirs, names)
+
+    files = dict()
+    failed = set()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = dict()
+        for rel_dir, (_, names) in dirs.items():
+            for name in names:
+                rel_path = os.path.normpath(os.path.join(rel_dir, name))
+                src_path = os.path.join(dir_path, rel_path)
+                _export_original(src_path, os.path.join(output_path, rel_path))
+                identity = list(_get_file_identity(src_path))
+                entry = manifest['files'].get(rel_path)
+                if (not reprocess and entry is not None and entry['identity'] == identity
+                        and 'fingerprint' in entry['meta']):
+                    files[rel_path] = entry
+                    continue
+                export_dir = os.path.join(output_path, rel_dir, EXPORT_DIR_NAME, 'files', name)
+                shutil.rmtree(export_dir, ignore_errors=True)
+                future = executor.submit(_export_file, src_path, export_dir, THUMBNAIL_SIZES)
+                futures[future] = (rel_path, identity)
+        for i, future in enumerate(as_completed(futures), 1):
+            rel_path, identity = futures[future]
+            meta, exported = future.result()
+            files[rel_path] = {'identity': identity, 'meta': meta}
+            if not exported:
+                failed.add(rel_path)
+            print('[{i}/{total}] {path}'.format(i=i, total=len(futures), path=rel_path))
+
+    # remove what was exported before, but is gone from the source
+    for rel_path in manifest['files']:
+        if rel_path not in files:
+            rel_dir, name = os.path.split(rel_path)
+            shutil.rmtree(os.path.join(output_path, rel_dir, EXPORT_DIR_NAME, 'files', name),
+                          ignore_errors=True)
+            try:
+                os.remove(os.path.join(output_path, rel_path))
+            except OSError:
+                pass
+    for rel_dir in sorted(manifest['dirs'], key=len, reverse=True):
+        if rel_dir not in dirs:
+            shutil.rmtree(os.path.join(output_path, rel_dir, EXPORT_DIR_NAME), ignore_errors=True)
+            try:
+                os.remove(os.path.join(output_path, rel_dir, 'index.html'))
+                os.rmdir(os.path.join(output_path, rel_dir))
+            except OSError:
+                pass
+
+    enc = sys.getfilesystemencoding()
+    for rel_dir, (subdirs, names) in dirs.items():
+        data_dir = os.path.join(output_path, rel_dir, EXPORT_DIR_NAME)
+        os.makedirs(data_dir, exist_ok=True)
+        entries = [(name, files[os.path.normpath(os.path.join(rel_dir, name))]) for name in names]
+        _write_exported_json([dict(name=name, **entry['meta']) for name, entry in entries],
+                             os.path.join(data_dir, 'list.json'))
+        display_path = '/' if rel_dir == os.curdir else '/' + rel_dir.replace(os.sep, '/') + '/'
+        html_str = get_gallery_html(html.escape(display_path, quote=False),
+                                    [os.path.join(dir_path, rel_dir, name) for name in subdirs],
+                                    static_export=True)
+        with open(os.path.join(output_path, rel_dir, 'index.html'), 'wb') as f:
+            f.write(html_str.encode(enc, 'surrogateescape'))
+    with open(os.path.join(output_path, 'favicon.ico'), 'wb') as f:
+        f.write(ICON)
+
+    # failed files are left out of manifest, so next export tries them again
+    manifest = {'params': params, 'dirs': sorted(dirs),
+                'files': {rel_path: entry for rel_path, entry in files.items() if rel_path not in failed}}
+    _write_exported_json(manifest, manifest_path)
+    print('Exported {total} files ({changed} changed, {failed} failed) to {path}'.format(
+        total=len(files), changed=len(futures), failed=len(failed), path=output_path))
+
+
+def run_server(port, dir_path, thumbnail_sizes=None, cache_dir=THUMBNAIL_CACHE_DIR,
+               cache_size=THUMBNAIL_CACHE_MAX_SIZE, workers=1,
+               memory_cache_size=MEMORY_CACHE_SIZE, frame_cache_size=FRAME_CACHE_SIZE, prefetch=PREFETCH_WINDOW,
+               rate_limit=RATE_LIMIT, client_rate_limit=CLIENT_RATE_LIMIT,
+               thumbnail_formats=None, thumbnail_quality=THUMBNAIL_QUALITY, progressive=THUMBNAIL_PROGRESSIVE,
+               preload=PRELOAD_THUMBNAILS, access_log=ACCESS_LOG, access_log_level=ACCESS_LOG_LEVEL,
+               access_log_sample=ACCESS_LOG_SAMPLE, access_log_max_size=ACCESS_LOG_MAX_SIZE):
     """
     Run the image server. This is blocking. Will handle user KeyboardInterrupt
     and other exceptions appropriately and return control once the server is
@@ -1040,11 +4362,67 @@ def run_server(port, dir_path):
 
     @param {Integer} port - The port number to serve on
     @param {String} dir_path - The directory path (absolute, or relative to CWD)
+    @param {List} thumbnail_sizes - Thumbnail height buckets requested sizes are snapped to
+    @param {String} cache_dir - Thumbnail cache directory (empty or None disables cache)
+    @param {Integer} cache_size - Thumbnail cache size limit in bytes (0 disables limit)
+    @param {Integer} workers - Number of server processes sharing the port (POSIX only)
+    @param {Integer} memory_cache_size - In-memory cache budget in bytes per process (0 disables cache)
+    @param {Integer} frame_cache_size - Decoded-frame cache budget in bytes per process (0 disables cache)
+    @param {Integer} prefetch - Number of items on each side of previewed one loaded in advance
+    @param {Integer} rate_limit - Total bandwidth limit in bytes per second (0 disables limit)
+    @param {Integer} client_rate_limit - Bandwidth limit of single client IP in bytes per second (0 disables limit)
+    @param {List} thumbnail_formats - Generated images formats by preference, first accepted by client is used
+    @param {Integer} thumbnail_quality - Generated images quality, 1-100
+    @param {Boolean} progressive - Encode generated JPEG images as progressive
+    @param {Integer} preload - Number of first thumbnails announced by preload headers of gallery page
+    @param {String} access_log - JSON lines access log file path, '-' for stderr (empty or None disables log)
+    @param {String} access_log_level - Lowest logged level: 'info' (all requests), 'warning' or 'error'
+    @param {Float} access_log_sample - Fraction of successful requests logged, 0-1
+    @param {Integer} access_log_max_size - Size in bytes at which log file is rotated (0 disables rotation)
 
     @return {None}
     """
-    global META_API
+    global META_API, THUMBNAIL_SIZES, THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_MAX_SIZE, MEMORY_CACHE, FRAME_CACHE
+    global PREFETCH_WINDOW
+    global RATE_LIMIT, CLIENT_RATE_LIMIT, _GLOBAL_BUCKET, _CLIENT_BUCKETS
+    global THUMBNAIL_FORMATS, THUMBNAIL_QUALITY, THUMBNAIL_PROGRESSIVE, PRELOAD_THUMBNAILS
+    global ACCESS_LOG, ACCESS_LOG_LEVEL, ACCESS_LOG_SAMPLE, ACCESS_LOG_MAX_SIZE
     META_API = MetaApi(root_path=dir_path)
+    if thumbnail_sizes and min(thumbnail_sizes) <= 0:
+        raise ValueError('Thumbnail sizes must be positive.')
+    if thumbnail_sizes:
+        THUMBNAIL_SIZES = sorted(thumbnail_sizes)
+    THUMBNAIL_CACHE_DIR = cache_dir if cache_dir and _prepare_cache_dir(cache_dir) else None
+    THUMBNAIL_CACHE_MAX_SIZE = cache_size
+    if THUMBNAIL_CACHE_DIR and THUMBNAIL_CACHE_MAX_SIZE > 0:
+        # bound cache left by previous runs as well
+        threading.Thread(target=_trim_cache, daemon=True).start()
+    MEMORY_CACHE = _LruCache(memory_cache_size)
+    FRAME_CACHE = _LruCache(frame_cache_size)
+    PREFETCH_WINDOW = prefetch
+    PRELOAD_THUMBNAILS = preload
+    ACCESS_LOG = access_log
+    ACCESS_LOG_LEVEL = access_log_level
+    ACCESS_LOG_SAMPLE = access_log_sample
+    ACCESS_LOG_MAX_SIZE = access_log_max_size
+    RATE_LIMIT = rate_limit
+    CLIENT_RATE_LIMIT = client_rate_limit
+    # worker processes share buckets, so limits hold for the server as a whole
+    shared = workers > 1 and hasattr(os, 'fork')
+    _GLOBAL_BUCKET = None
+    if RATE_LIMIT > 0:
+        state, lock = _make_bucket_state(1, shared)
+        _GLOBAL_BUCKET = _TokenBucket(RATE_LIMIT, state, 0, lock)
+    _CLIENT_BUCKETS = _ClientBuckets(CLIENT_RATE_LIMIT, CLIENT_BUCKETS_SIZE, shared) \
+        if CLIENT_RATE_LIMIT > 0 else None
+    if thumbnail_formats:
+        THUMBNAIL_FORMATS = thumbnail_formats
+    THUMBNAIL_QUALITY = thumbnail_quality
+    THUMBNAIL_PROGRESSIVE = progressive
+    unsupported = [fmt for fmt in THUMBNAIL_FORMATS if fmt not in _get_encodable_formats()]
+    if unsupported:
+        print('WARNING: no encoder for {formats} thumbnails, install Pillow with their support.'.format(
+            formats=', '.join(unsupported)))
 
     if sys.version_info.major == 3 and sys.version_info.minor < 7:
         os.chdir(dir_path)
@@ -1052,18 +4430,20 @@ def run_server(port, dir_path):
     else:
         request_handler = partial(RequestHandler, directory=dir_path)
 
-    # Configure allow_reuse_address to make re-runs of the script less painful -
-    # if this is not True then waiting for the address to be freed after the
-    # last run can block a subsequent run
-    socketserver.TCPServer.allow_reuse_address = True
     # Create the server instance
-    server = socketserver.ThreadingTCPServer(
+    server = GalleryServer(
         ('', port),
         request_handler
     )
 
     print('Your images are at http://127.0.0.1:{port}/'.format(port=port))
     print('In case you want access server from remote client check firewall rules.')
+    if workers > 1:
+        if hasattr(os, 'fork'):
+            print('Serving with {workers} worker processes'.format(workers=workers))
+            _serve_workers(server, workers)
+            return
+        print('WARNING: worker processes are not supported on this platform, serving in single process.')
     # Try to run the server
     try:
         # Run it - this call blocks until the server is killed
@@ -1077,17 +4457,113 @@ def run_server(port, dir_path):
         # and faults actually starting the server in the first place
         print(err)
         print('Unhandled exception in server, stopping')
+    _flush_access_log(ACCESS_LOG_FLUSH_TIMEOUT)
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Run server with media preview from directory.')
-    parser.add_argument('--directory', '-d', default=os.getcwd(),
-                        help='shared directory path '
-                             '[default: current directory]')
-    parser.add_argument('port', action='store',
-                        default=8000, type=int,
-                        nargs='?',
-                        help='server port number [default: 8000]')
-    args = parser.parse_args()
-
-    run_server(args.port, os.path.expanduser(args.directory))
+    parser = argparse.ArgumentParser(description='Run server with media preview from directory, '
+                                                 'or export its gallery as static site.')
+    subparsers = parser.add_subparsers(dest='command', metavar='{serve,export}')
+    serve_parser = subparsers.add_parser('serve', help='run server, the default command',
+                                         description='Run server with media preview from directory.')
+    serve_parser.add_argument('--directory', '-d', default=os.getcwd(),
+                              help='shared directory path '
+                                   '[default: current directory]')
+    serve_parser.add_argument('port', action='store',
+                              default=8000, type=int,
+                              nargs='?',
+                              help='server port number [default: 8000]')
+    serve_parser.add_argument('--thumbnail-sizes', default=','.join(str(size) for size in THUMBNAIL_SIZES),
+                              type=_parse_thumbnail_sizes,
+                              help='comma separated thumbnail heights requested sizes are snapped to '
+                                   '[default: %(default)s]')
+    serve_parser.add_argument('--cache-dir', default=THUMBNAIL_CACHE_DIR,
+                              help='thumbnail cache directory, empty string disables cache '
+                                   '[default: %(default)s]')
+    serve_parser.add_argument('--cache-size', default=THUMBNAIL_CACHE_MAX_SIZE // (1024 * 1024), type=int,
+                              help='thumbnail cache size limit in MiB, least recently used thumbnails '
+                                   'are removed above it, 0 disables limit [default: %(default)s]')
+    serve_parser.add_argument('--workers', '-w', default=1, type=int,
+                              help='number of server processes sharing the port (POSIX only) '
+                                   '[default: %(default)s]')
+    serve_parser.add_argument('--memory-cache-size', default=MEMORY_CACHE_SIZE // (1024 * 1024), type=int,
+                              help='in-memory cache of thumbnails and API responses per process in MiB, '
+                                   '0 disables cache [default: %(default)s]')
+    serve_parser.add_argument('--frame-cache-size', default=FRAME_CACHE_SIZE // (1024 * 1024), type=int,
+                              help='in-memory cache of downscaled frames of multi-frame images per process '
+                                   'in MiB, 0 disables cache [default: %(default)s]')
+    serve_parser.add_argument('--prefetch', default=PREFETCH_WINDOW, type=int,
+                              help='number of items on each side of previewed one loaded in advance '
+                                   '[default: %(default)s]')
+    serve_parser.add_argument('--preload', default=PRELOAD_THUMBNAILS, type=int,
+                              help='number of first thumbnails announced in preload headers of gallery page, '
+                                   'so browser requests them before running page script [default: %(default)s]')
+    serve_parser.add_argument('--rate-limit', default=RATE_LIMIT, type=float,
+                              help='total bandwidth limit in MiB/s, 0 disables limit [default: %(default)s]')
+    serve_parser.add_argument('--client-rate-limit', default=CLIENT_RATE_LIMIT, type=float,
+                              help='bandwidth limit of single client IP in MiB/s, 0 disables limit '
+                                   '[default: %(default)s]')
+    serve_parser.add_argument('--thumbnail-formats', default=','.join(THUMBNAIL_FORMATS),
+                              type=lambda value: value.split(','),
+                              help='comma separated generated images formats by preference (avif, webp, jpg), '
+                                   'first one accepted by browser is used, non JPEG formats need Pillow '
+                                   '[default: %(default)s]')
+    serve_parser.add_argument('--thumbnail-quality', default=THUMBNAIL_QUALITY, type=int,
+                              help='generated images quality, 1-100 [default: %(default)s]')
+    serve_parser.add_argument('--no-progressive', dest='progressive', action='store_false',
+                              help='encode generated JPEG images as baseline instead of progressive')
+    serve_parser.add_argument('--access-log', default=ACCESS_LOG,
+                              help='access log file path of JSON lines, "-" for stderr, empty string disables log '
+                                   '[default: %(default)s]')
+    serve_parser.add_argument('--access-log-level', default=ACCESS_LOG_LEVEL, choices=ACCESS_LOG_LEVELS,
+                              help='lowest logged level, info logs all requests, warning client errors, '
+                                   'error server errors and timed out requests [default: %(default)s]')
+    serve_parser.add_argument('--access-log-sample', default=ACCESS_LOG_SAMPLE, type=float,
+                              help='fraction of successful requests logged, 0-1, errors are always logged '
+                                   '[default: %(default)s]')
+    serve_parser.add_argument('--access-log-max-size', default=ACCESS_LOG_MAX_SIZE // (1024 * 1024), type=int,
+                              help='size of access log file in MiB at which it is rotated, '
+                                   '{backups} backups are kept, 0 disables rotation [default: %(default)s]'.format(
+                                       backups=ACCESS_LOG_BACKUPS))
+    export_parser = subparsers.add_parser('export', help='export gallery as static site',
+                                          description='Export gallery of directory as static site.')
+    export_parser.add_argument('--directory', '-d', default=os.getcwd(),
+                               help='exported directory path '
+                                    '[default: current directory]')
+    export_parser.add_argument('output',
+                               help='output directory path, export into the same directory is incremental')
+    export_parser.add_argument('--thumbnail-sizes', default=','.join(str(size) for size in THUMBNAIL_SIZES),
+                               type=_parse_thumbnail_sizes,
+                               help='comma separated thumbnail heights to generate '
+                                    '[default: %(default)s]')
+    export_parser.add_argument('--jobs', '-j', default=None, type=int,
+                               help='number of worker processes [default: number of CPUs]')
+    argv = sys.argv[1:]
+    # serve is the default command, so options of server may be given without it
+    if not argv or argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help'):
+        argv = ['serve'] + argv
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        export_gallery(os.path.expanduser(args.directory), os.path.expanduser(args.output),
+                       thumbnail_sizes=args.thumbnail_sizes,
+                       jobs=args.jobs)
+    else:
+        run_server(args.port, os.path.expanduser(args.directory),
+                   thumbnail_sizes=args.thumbnail_sizes,
+                   cache_dir=os.path.expanduser(args.cache_dir),
+                   cache_size=args.cache_size * 1024 * 1024,
+                   workers=args.workers,
+                   memory_cache_size=args.memory_cache_size * 1024 * 1024,
+                   frame_cache_size=args.frame_cache_size * 1024 * 1024,
+                   prefetch=args.prefetch,
+                   preload=args.preload,
+                   rate_limit=args.rate_limit * 1024 * 1024,
+                   client_rate_limit=args.client_rate_limit * 1024 * 1024,
+                   thumbnail_formats=args.thumbnail_formats,
+                   thumbnail_quality=args.thumbnail_quality,
+                   progressive=args.progressive,
+                   access_log=args.access_log and os.path.expanduser(args.access_log),
+                   access_log_level=args.access_log_level,
+                   access_log_sample=args.access_log_sample,
+                   access_log_max_size=args.access_log_max_size * 1024 * 1024)